@@ -1,15 +1,20 @@
+import asyncio
 import json
 import os
 import subprocess
 import tempfile
-import threading
+import time
 
 import urwid
 
-from custom_widgets.chat import ChatHistory, EditableChatBubble
+from custom_widgets.chat import ChatHistory, TerminalWidth
 from custom_widgets.model_select import ModelEntry, PopupMenu
 from custom_widgets.vimkey import VimKeyHandler
-from models.main import get_completion
+from models import http
+from models.main import continuation_messages, get_completion, prewarm
+from models.metrics import StreamStats, describe_error, log_metrics
+from storage import open_store
+from storage.autosave import Autosaver
 
 
 def edit_in_editor(content):
@@ -24,12 +29,13 @@ def edit_in_editor(content):
     return new_content
 
 class VimFooter(urwid.WidgetWrap):
-    def __init__(self, model_name=None, provider=None, mode=None, key_sequence=None, chat_file=None):
+    def __init__(self, model_name=None, provider=None, mode=None, key_sequence=None, chat_file=None, stats=None):
         self.model_name = model_name or ""
         self.provider = provider or ""
         self.mode = mode or "Normal"
         self.key_sequence = key_sequence or ""
         self.chat_file = chat_file or ""
+        self.stats = stats or ""
         self._update_header()
 
     def _mode_attr_name(self):
@@ -53,18 +59,20 @@ class VimFooter(urwid.WidgetWrap):
              ('weight', 5, chat_file_text)
         ], dividechars=0)
 
-        # Right side: key sequence
+        # Right side: stats of the last response and key sequence
+        stats_text = urwid.AttrMap(urwid.Text(f"{self.stats} ", align='right'), 'header_stats')
         right_side = urwid.Text(f"{self.key_sequence} ", align='right')
 
         # Whole header layout
         header_columns = urwid.Columns([
             ('weight', 1, left_side),
+            ('pack', stats_text),
             ('pack', right_side)
         ])
 
         self._w = urwid.AttrMap(header_columns, 'header')
 
-    def update(self, mode=None, model_name=None, provider=None, key_sequence=None, chat_file=None):
+    def update(self, mode=None, model_name=None, provider=None, key_sequence=None, chat_file=None, stats=None):
         if mode is not None:
             self.mode = mode
         if model_name is not None:
@@ -75,17 +83,58 @@ class VimFooter(urwid.WidgetWrap):
             self.key_sequence = key_sequence
         if chat_file is not None:
             self.chat_file = chat_file
+        if stats is not None:
+            self.stats = stats
 
         self._update_header()
 
+class RedrawScheduler:
+    # Coalesces redraw requests so the screen is painted at most max_fps
+    # times per second. Pending work is applied by before_draw on each tick.
+    def __init__(self, loop, max_fps=30, before_draw=None):
+        self.loop = loop
+        self.interval = 1 / max_fps if max_fps else 0
+        self.before_draw = before_draw
+        self._last_draw = 0.0
+        self._alarm = None
+
+    def request(self):
+        elapsed = time.monotonic() - self._last_draw
+        if elapsed >= self.interval:
+            self.flush()
+        elif self._alarm is None:
+            self._alarm = self.loop.set_alarm_in(self.interval - elapsed, self._on_alarm)
+
+    def _on_alarm(self, loop, user_data):
+        self._alarm = None
+        self.flush()
+
+    def flush(self):
+        if self._alarm is not None:
+            self.loop.remove_alarm(self._alarm)
+            self._alarm = None
+        if self.before_draw is not None:
+            self.before_draw()
+        self.loop.draw_screen()
+        self._last_draw = time.monotonic()
+
 class ChatApp:
-    def __init__(self, chat_file, model, available_models):
+    RESIZE_DEBOUNCE = 0.15
+    # how often a streaming answer is written to the chat file
+    CHECKPOINT_INTERVAL = 2.0
+    CHECKPOINT_CHARS = 4096
+    # chat files bigger than this without an index are loaded in the background
+    BACKGROUND_LOAD_BYTES = 1 << 20
+
+    def __init__(self, chat_file, model, available_models, max_fps=30, metrics_log=None, blobs=None):
         # Color palette: user, assistant messages, focus highlight, footer
         self._busy = False
+        self._resize_alarm = None
 
         self.palette = [
             ('header_file', 'dark magenta', 'black'),
             ('header', 'light gray', 'black'),
+            ('header_stats', 'dark cyan', 'black'),
             ('mode_normal', 'black,bold', 'dark cyan'),
             ('mode_insert', 'black,bold', 'dark blue'),
             ('mode_visual', 'black,bold', 'dark magenta'),
@@ -102,62 +151,194 @@ class ChatApp:
         self.model = model
         print(model)
         self.available_models = available_models
+        self.metrics_log = metrics_log
 
-        self.compelte = None
-        threading.Thread(target=self.load_model, daemon=True).start()
+        self.complete = None
 
         messages = []
+        self.loading = False
+        self._send_after_load = False
 
         if chat_file is not None:
             self.chat_file = chat_file
+            self.store = open_store(chat_file, blobs)
             try:
-                with open(self.chat_file, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
+                if self.store.indexed() or os.path.getsize(chat_file) < self.BACKGROUND_LOAD_BYTES:
+                    messages = self.store.load()
+                else:
+                    # start with an empty draft, the history fills in above it
+                    self.loading = True
+            except (json.JSONDecodeError, OSError):
                 pass
 
-        self.chat_history = ChatHistory(messages=messages)
+        self.width = TerminalWidth()
+        # changes go to the chat file as they happen, full saves in the background
+        self.autosave = Autosaver(self.store, lambda: self.chat_history.to_dict(), on_error=self._show_save_error)
+        self.chat_history = ChatHistory(messages=messages, width=self.width, on_change=self.on_change)
 
         self.footer = VimFooter(model_name=model["name"], provider=model["provider"], mode="Normal", key_sequence="", chat_file=self.chat_file)
 
-        self.main = VimKeyHandler(chat_history=self.chat_history, header=None, footer=self.footer)
+        self.main = VimKeyHandler(chat_history=self.chat_history, header=None, footer=self.footer,
+                                  on_insert=self.prewarm)
 
         self.model_select = PopupMenu([ModelEntry(model) for model in self.available_models.values()], on_select=self.select_model, on_close=self.open_main_view)
 
+        # Everything runs as tasks on one asyncio loop driven by urwid
+        self.aloop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.aloop)
+
         # Main loop with key handler
         self.loop = urwid.MainLoop(
             self.main,
             self.palette,
             unhandled_input=self.handle_input,
             input_filter=self.input_filter,
+            event_loop=urwid.AsyncioEventLoop(loop=self.aloop),
         )
 
-    def load_model(self):
-        # This method is used to load the model in a separate thread
-        # to avoid blocking the main loop
-        self.complete = get_completion(self.model)
-        self.loop.draw_screen()
+        self._pending_chunks = []
+        self._response_message = None
+        self._response_task = None
+        self._stats = None
+        self.redraw = RedrawScheduler(self.loop, max_fps=max_fps, before_draw=self._apply_pending_chunks)
+
+        self.spawn(self.load_model())
+        self._autosave_task = self.spawn(self.autosave.run())
+        self._load_task = self.spawn(self.load_history()) if self.loading else None
+
+        self._show_interrupted()
+
+    def _show_save_error(self, error):
+        self.footer.update(stats=f"not saved: {describe_error(error)}")
+
+    def _show_interrupted(self):
+        last = self.chat_history.message_list[-1]
+        if last.incomplete:
+            self.footer.update(stats="answer was interrupted: r resume, R regenerate")
+
+    def spawn(self, coro):
+        task = self.aloop.create_task(coro)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        error = task.exception()
+
+        def reraise(loop, user_data):
+            raise error
+        # raising from a urwid callback stops the main loop like before
+        self.loop.set_alarm_in(0, reraise)
+
+    async def load_model(self):
+        # Importing a provider can be slow, keep it off the loop
+        model = self.model
+        try:
+            complete = await asyncio.to_thread(get_completion, model)
+        except Exception as error:
+            # a provider that can't be set up only fails its own answers
+            if model is self.model:
+                self.footer.update(stats=f"{model['provider']}: {describe_error(error)}")
+            return
+        if model is self.model:
+            self.complete = complete
+            # connect while the user is still typing
+            await prewarm(complete)
+
+    def prewarm(self):
+        # before the model is loaded, load_model prewarms once it is
+        if self.complete is not None:
+            self.spawn(prewarm(self.complete))
+
+    async def load_history(self):
+        walker = self.chat_history.message_list
+        batches = self.store.load_batches()
+        try:
+            while True:
+                # parsing happens on a worker, the UI stays responsive
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                start, messages, fraction = batch
+                walker.load(start, messages)
+                self.footer.update(stats=f"loading chat {fraction:.0%}")
+                if self.loop.screen.started:
+                    self.redraw.request()
+        except (json.JSONDecodeError, OSError):
+            self.footer.update(stats="could not read all of the chat file")
+        else:
+            self.footer.update(stats="")
+            if self._drop_empty_draft(walker.frozen):
+                # an empty draft is not a question
+                self._send_after_load = False
+            self._show_interrupted()
+            if len(walker) != walker.frozen or self.store.needs_index():
+                # nothing was journaled while loading, write the whole chat
+                # once; an untouched compressed file is left as it is
+                self.store.invalidate()
+                self.autosave.request()
+        finally:
+            batches.close()
+            walker.finish_loading()
+            self.loading = False
+        if self._send_after_load:
+            self._send_after_load = False
+            self.get_response()
+        if self.loop.screen.started:
+            self.redraw.request()
+
+    def _drop_empty_draft(self, loaded):
+        # the draft shown while loading is only kept if something was typed
+        # into it; otherwise the chat opens like a small one would
+        walker = self.chat_history.message_list
+        if len(walker) != loaded + 1 or loaded == 0:
+            return False
+        draft = walker[loaded]
+        if draft.get_content() or draft.role != 'user':
+            return False
+        if draft.in_insert_mode():
+            draft.leave_insert_mode()
+            self.main.set_insert_mode(False)
+        del walker[loaded]
+        self.chat_history.set_focus(loaded - 1)
+        return True
 
     def input_filter(self, input_list, raw_input):
         if 'window resize' in input_list:
-            self.chat_history.rebuild()
-        if self._busy:
-            # filter out all “enter” presses
+            self.schedule_rebuild()
+        if self._busy and not self.main.insert_mode:
+            # no sending while an answer streams; in insert mode enter is a
+            # newline in the next prompt
             return [k for k in input_list if k != 'enter']
         return input_list
 
 
 
+    def schedule_rebuild(self):
+        # dragging a pane border sends a burst of resizes, only act on the last
+        if self._resize_alarm is not None:
+            self.loop.remove_alarm(self._resize_alarm)
+        self._resize_alarm = self.loop.set_alarm_in(self.RESIZE_DEBOUNCE, self._rebuild)
+
+    def _rebuild(self, loop=None, user_data=None):
+        self._resize_alarm = None
+        self.width.update(self.loop.screen.get_cols_rows()[0])
+        self.chat_history.rebuild()
+
     def selectable(self):
         return True
 
     def edit_message_in_editor(self, msg_index):
+        if self.chat_history.is_locked(msg_index):
+            return
         widget = self.chat_history.message_list[msg_index]
         content = widget.get_content()
         new_content = edit_in_editor(content)
 
-        widget.content = new_content
-        widget.update()
+        if widget.in_insert_mode():
+            widget.leave_insert_mode()
+        self.chat_history.edit_message(msg_index, new_content)
 
         focus_idx = msg_index
         if 0 <= focus_idx < len(self.chat_history.message_list):
@@ -171,7 +352,7 @@ class ChatApp:
     def select_model(self, model):
         self.model = model 
         self.complete = None
-        threading.Thread(target=self.load_model, daemon=True).start()
+        self.spawn(self.load_model())
         self.footer.update(model_name=self.model["name"], provider=self.model["provider"])
         self.loop.widget = self.main
 
@@ -186,44 +367,186 @@ class ChatApp:
         )
         self.loop.widget = model_select_overlay
 
-    def get_response(self):
-        # add placeholder for assistant
-        response_message = EditableChatBubble(content="", role='assistant') 
-        self.chat_history.message_list.append(response_message)
-
-        last_index = len(self.chat_history.message_list) - 1
-        self.chat_history.set_focus(last_index, "below")
-
-        self.loop.draw_screen()
-
+    def get_response(self, index=None, resume=False):
+        history = self.chat_history
+        if index is None:
+            messages = history.to_messages()
+            # add placeholder for assistant, marked incomplete until it's done
+            response_message = history.append_message(role='assistant', incomplete=True)
+            index = len(history.message_list) - 1
+        else:
+            messages = history.to_messages()[:index]
+            if resume:
+                response_message = history.message_list[index]
+                messages = continuation_messages(messages, response_message.content)
+                history.update_message(index, truncated=None, incomplete=True)
+            else:
+                # what was there from index on stays available as a branch
+                response_message = history.fork_message(index, role='assistant', incomplete=True)
+        response_message.start_stream()
+
+        self.chat_history.set_focus(index, "below")
+
+        self._checkpointed = len(response_message.content)
+        self._last_checkpoint = time.monotonic()
+        self._response_message = response_message
+        self._busy = True
+        self._stats = StreamStats(self.model["name"], self.model["provider"], on_retry=self._show_retry)
+        self.footer.update(stats=self._stats.summary())
+        self._response_task = self.spawn(self._generate(self.model, messages, self._stats))
+
+    async def _generate(self, model, messages, stats):
+        response = None
+        completed = False
+        try:
+            complete = self.complete
+            if complete is None:
+                complete = await asyncio.to_thread(get_completion, model)
+            response = complete(model=model["name"], messages=messages, stats=stats)
+            async for chunk in response:
+                stats.record(chunk)
+                self._pending_chunks.append(chunk)
+                self.redraw.request()
+            completed = True
+        except Exception as error:
+            # out of retries, or not worth one; what came in is kept
+            stats.error = describe_error(error)
+        finally:
+            # closes the underlying HTTP stream, also on cancel
+            if response is not None:
+                await response.aclose()
+            self._finish_response(incomplete=not completed)
+        if stats.error is not None:
+            self.footer.update(stats=f"{stats.error} (r resume, R regenerate)")
+
+    def _show_retry(self, stats):
+        if stats is self._stats:
+            self.footer.update(stats=stats.summary())
+            self.redraw.request()
+
+    def resume_response(self, regenerate=False):
+        # continue or redo the focused answer if it was cut off
+        if self._busy or self.loading or self.chat_history.focus is None:
+            return
+        message = self.chat_history.focus
+        if message.role != 'assistant' or message.in_insert_mode():
+            return
+        if not regenerate and not (message.incomplete or message.truncated):
+            return
+        self.get_response(self.chat_history.focus_position, resume=not regenerate)
+
+    def branch_response(self):
+        # answer the focused message, the messages after it become a branch
+        if self._busy or self.loading or self.chat_history.focus is None:
+            return
+        if self.chat_history.focus.in_insert_mode():
+            return
+        position = self.chat_history.focus_position
+        if position < len(self.chat_history.message_list) - 1:
+            self.get_response(position + 1)
+        else:
+            # an edited message is already the last one of its branch
+            self.get_response()
+
+    def cancel_response(self):
+        if self._response_task is None or self._response_task.done():
+            return
+        self._finish_response(truncated=True)
+        self._response_task.cancel()
+
+    def _apply_pending_chunks(self):
+        if self._response_message is None or not self._pending_chunks:
+            return
+        self._response_message.append("".join(self._pending_chunks))
+        self._pending_chunks.clear()
+        if self._stats is not None:
+            self.footer.update(stats=self._stats.summary())
+        # only follow the stream if the user hasn't scrolled away
+        if self.chat_history.focus is self._response_message:
+            self.chat_history.set_focus_valign("bottom")
 
-        if self.complete is None:
-            self.load_model()
+        pending = len(self._response_message.get_content()) - self._checkpointed
+        if pending >= self.CHECKPOINT_CHARS or time.monotonic() - self._last_checkpoint >= self.CHECKPOINT_INTERVAL:
+            self._checkpoint()
+
+    def _checkpoint(self, **flags):
+        # write what has streamed in so far, so a crash doesn't lose it
+        message = self._response_message
+        self._last_checkpoint = time.monotonic()
+        try:
+            index = self.chat_history.message_list.position_of(message)
+        except ValueError:
+            # deleted while it was streaming
+            return
+        text = message.get_content()
+        self.chat_history.message_list.append_text(index, text[self._checkpointed:], **flags)
+        self._checkpointed = len(text)
+
+    def _finish_response(self, truncated=False, incomplete=False):
+        if self._response_message is None:
+            return
+        self.redraw.flush()
+        message = self._response_message
+        message.finish_stream(truncated=truncated, incomplete=incomplete)
+        self._checkpoint(truncated=truncated, incomplete=incomplete)
+        self._response_message = None
+        self._busy = False
+        self._record_stats(cancelled=truncated)
+        if incomplete:
+            self.footer.update(stats="answer was interrupted: r resume, R regenerate")
+
+    def _record_stats(self, cancelled=False):
+        stats, self._stats = self._stats, None
+        if stats is None:
+            return
+        stats.finish(cancelled=cancelled)
+        self.footer.update(stats=stats.summary())
+        if self.metrics_log:
+            try:
+                log_metrics(stats, self.metrics_log)
+            except OSError:
+                pass
 
-        messages = [msg.to_dict() for msg in self.chat_history.message_list[:-1]]
-        response = self.complete(model=self.model["name"], messages=messages) # type: ignore
-        for chunk in response: # type: ignore
-            response_message.content += chunk
-            response_message.update()
-            self.chat_history.set_focus_valign("bottom")
-            self.loop.draw_screen()
+    def on_change(self, op):
+        if self.loading:
+            # the file is still being read, it gets rewritten once that's done
+            return
+        self.store.record(op)
+        self.autosave.request()
 
     def write_changes(self):
-        with open(self.chat_file, 'w', encoding='utf-8') as f:
-            json.dump(self.chat_history.to_dict(), f, ensure_ascii=False, indent=2)
+        self.chat_history.message_list.sync_edits()
+        self.store.save(self.chat_history.to_dict())
 
     def handle_input(self, key):
         if key == "enter":
             if self._busy:
                 return None
-            self._busy = True
-            try:
-                self.get_response()
-            finally:
-                self._busy = False
+            if self.loading:
+                # the model needs the whole conversation
+                self._send_after_load = True
+                self.footer.update(stats="sending once the chat is loaded")
+                return None
+            self.get_response()
             return None
 
 
+        elif key == 'ctrl c':
+            self.cancel_response()
+            return None
+
+        elif key == 'r':
+            self.resume_response()
+            return None
+
+        elif key == 'R':
+            self.resume_response(regenerate=True)
+            return None
+
+        elif key == 'b':
+            self.branch_response()
+            return None
+
         elif key == 'ctrl e':
             idx = self.main.chat_history.focus_position
             self.edit_message_in_editor(idx)
@@ -239,8 +562,25 @@ class ChatApp:
 
     def run(self):
         print("Starting chat application...")
+        # deliver ctrl c as a key so it can cancel a response
+        self.loop.screen.tty_signal_keys(intr="undefined")
         self.loop.run()
 
     def shutdown(self):
-        self.write_changes()
+        if self._load_task is not None and not self._load_task.done():
+            # saving a partly loaded chat would drop the rest of it
+            self._send_after_load = False
+            self.aloop.run_until_complete(self._load_task)
+        if self._response_task is not None and not self._response_task.done():
+            # checkpoint what streamed in, resumable with r next time
+            self._finish_response(incomplete=True)
+            self._response_task.cancel()
+            self.aloop.run_until_complete(asyncio.gather(self._response_task, return_exceptions=True))
+        self._autosave_task.cancel()
+        self.aloop.run_until_complete(self.autosave.wait())
+        self.chat_history.message_list.sync_edits()
+        if self.store.needs_save():
+            self.write_changes()
+        self.store.close()
+        self.aloop.run_until_complete(http.aclose())
 
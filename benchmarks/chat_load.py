@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Time opening a large chat: building the history and drawing the first frame.
+
+Usage: python benchmarks/chat_load.py [MESSAGES]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from urwid import raw_display
+
+from custom_widgets.chat import ChatHistory, TerminalWidth
+
+
+class ScreenPerCall(TerminalWidth):
+    # the old behaviour: a Screen and a terminal query for every bubble
+    def get(self):
+        return raw_display.Screen().get_cols_rows()[0]
+
+
+def make_messages(n):
+    messages = []
+    for i in range(n):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = f"message {i}\n" + "lorem ipsum dolor sit amet " * (i % 20 + 1)
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def bench(messages, width):
+    start = time.perf_counter()
+    history = ChatHistory(messages=messages, width=width)
+    history.render((120, 40), focus=True)
+    return time.perf_counter() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    messages = make_messages(n)
+    per_call = bench(messages, ScreenPerCall())
+    shared = bench(messages, TerminalWidth())
+    print(f"{n} messages")
+    print(f"  screen per bubble: {per_call * 1000:8.1f} ms")
+    print(f"  shared width:      {shared * 1000:8.1f} ms")
+    print(f"  speedup:           {per_call / shared:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
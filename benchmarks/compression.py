@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Compare size, save and load time of plain and compressed chat files.
+
+Usage: python benchmarks/compression.py [MESSAGES]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import open_store
+from storage.index import as_dict, remove_index
+
+
+def make_messages(n):
+    # chat-like text: prose, pasted logs and code
+    messages = []
+    for i in range(n):
+        if i % 3 == 0:
+            content = f"Why does request {i} fail?\n" + "\n".join(
+                f"2024-05-0{i % 9 + 1} 12:{j:02d}:{i % 60:02d} ERROR worker-{j % 4} request {i * 7919 + j * 104729:x} "
+                f"timeout after {(i * j * 31) % 9973} ms" for j in range(40))
+        elif i % 3 == 1:
+            content = "Here is a fix:\n```python\n" + "\n".join(
+                f"def handler_{i}_{j}(request):\n    return retry(request, attempts={(i + j) % 5 + 1}, delay={(i * j) % 97})"
+                for j in range(20)) + "\n```"
+        else:
+            content = "Thanks, that worked. " * (i % 30 + 1)
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    return messages
+
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return time.perf_counter() - start, result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    messages = make_messages(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{n} messages")
+        print(f"  {'file':10} {'size':>9} {'save':>9} {'load':>9}")
+        plain = None
+        for suffix in (".json", ".json.gz", ".json.xz", ".json.bz2"):
+            path = os.path.join(tmp, "chat" + suffix)
+            save, _ = timed(lambda: open_store(path).save(messages))
+            # parse everything, like a file without an index
+            remove_index(path)
+            load, loaded = timed(lambda: [as_dict(m) for m in open_store(path).load()])
+            assert loaded == messages
+            size = os.path.getsize(path)
+            plain = plain or size
+            print(f"  {suffix:10} {size / 2**20:6.1f} MiB {save * 1000:6.0f} ms {load * 1000:6.0f} ms"
+                  f"  ({plain / size:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
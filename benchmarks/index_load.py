@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Time opening a large chat file with and without its offset index.
+
+Usage: python benchmarks/index_load.py [MESSAGES]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from custom_widgets.chat import ChatHistory, TerminalWidth
+from storage import open_store
+from storage.index import remove_index
+
+
+def make_messages(n):
+    messages = []
+    for i in range(n):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = f"message {i}\n" + "lorem ipsum dolor sit amet " * (i % 200 + 1)
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def bench(path):
+    start = time.perf_counter()
+    history = ChatHistory(messages=open_store(path).load(), width=TerminalWidth(120))
+    history.render((120, 40), focus=True)
+    return time.perf_counter() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    messages = make_messages(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("chat.json", "chat.jsonl"):
+            path = os.path.join(tmp, name)
+            open_store(path).save(messages)
+            indexed = bench(path)
+            remove_index(path)
+            parsed = bench(path)
+            size = os.path.getsize(path) / 2**20
+            print(f"{name}: {n} messages, {size:.0f} MiB")
+            print(f"  full parse: {parsed * 1000:8.1f} ms")
+            print(f"  indexed:    {indexed * 1000:8.1f} ms")
+            print(f"  speedup:    {parsed / indexed:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Time to first token with and without a prewarmed connection.
+
+Runs a local stand-in for an OpenAI-compatible server that delays every
+new connection by HANDSHAKE_MS, like DNS, TCP and TLS setup to a remote
+API would, and streams a short answer over it. Each trial starts with an
+empty connection pool: "cold" sends right away, "prewarmed" prewarms,
+waits while the user would be typing, then sends, and "other provider"
+then sends through a second provider for the same server, which reuses
+the shared pool.
+
+Usage: python benchmarks/ttft.py [TRIALS] [HANDSHAKE_MS]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import http
+from models.openai_compatible import create
+from models.prewarm import prewarm
+
+TYPING = 0.5  # seconds between prewarming and sending
+
+
+def chunk(delta, finish_reason=None):
+    return {"id": "x", "object": "chat.completion.chunk", "created": 0, "model": "stand-in",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+
+async def serve(reader, writer, handshake):
+    await asyncio.sleep(handshake)
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request, *lines = head.decode().split("\r\n")
+            headers = dict(line.lower().split(": ", 1) for line in lines if ": " in line)
+            await reader.readexactly(int(headers.get("content-length", 0)))
+            if request.startswith("GET /v1/models"):
+                body = json.dumps({"object": "list", "data": [{"id": "stand-in", "object": "model"}]}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            else:
+                events = [chunk({"role": "assistant", "content": "Hello"}), chunk({"content": " there"}),
+                          chunk({}, "stop")]
+                body = b"".join(b"data: %s\n\n" % json.dumps(event).encode() for event in events) + b"data: [DONE]\n\n"
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def ttft(complete):
+    start = time.perf_counter()
+    first = None
+    response = complete(model="stand-in", messages=[{"role": "user", "content": "hi"}])
+    try:
+        # read to the end like the app does, so the connection is reusable
+        async for _text in response:
+            first = first or time.perf_counter() - start
+    finally:
+        await response.aclose()
+    return first
+
+
+async def main(trials, handshake):
+    server = await asyncio.start_server(lambda r, w: serve(r, w, handshake), "127.0.0.1", 0)
+    base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1"
+    options = {"base_url": base_url, "stream_usage": False}
+    results = {"cold": [], "prewarmed": [], "other provider": []}
+    for _ in range(trials):
+        await http.aclose()
+        results["cold"].append(await ttft(create("bench", options)))
+        await http.aclose()
+        complete = create("bench", options)
+        await prewarm(complete)
+        await asyncio.sleep(TYPING)
+        results["prewarmed"].append(await ttft(complete))
+        results["other provider"].append(await ttft(create("other", options)))
+    await http.aclose()
+    server.close()
+
+    print(f"{trials} trials, {handshake * 1000:.0f} ms connection setup")
+    for name, times in results.items():
+        print(f"{name:>14}: median {statistics.median(times) * 1000:7.1f} ms  "
+              f"min {min(times) * 1000:7.1f} ms  max {max(times) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    handshake = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.15
+    asyncio.run(main(trials, handshake))
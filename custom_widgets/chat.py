@@ -1,16 +1,22 @@
+import shutil
+from collections import OrderedDict
+
 from urwid import (
     AttrMap,
     Edit,
     LineBox,
     ListBox,
     Padding,
-    SimpleListWalker,
+    Pile,
     Text,
     WidgetPlaceholder,
     WidgetWrap,
-    raw_display,
 )
 
+from custom_widgets.message_walker import MessageWalker
+from storage.index import as_dict
+from storage.ops import branches
+
 blocky_border_chars = {
     "tlcorner": "▄",  # Top-left corner
     "tline":    "▄",  # Top edge
@@ -22,27 +28,145 @@ blocky_border_chars = {
     "brcorner": "▀",  # Bottom-right corner
 }
 
+class TerminalWidth:
+    # Terminal columns shared by every bubble. The owner refreshes it on
+    # resize so building a bubble never has to query the terminal.
+    def __init__(self, cols=None):
+        self.cols = cols
+
+    def get(self):
+        if self.cols is None:
+            self.cols = shutil.get_terminal_size().columns
+        return self.cols
+
+    def update(self, cols):
+        self.cols = cols
+
+default_width = TerminalWidth()
+
+class BubbleCanvasCache:
+    # Rendered bubbles keyed by what they look like rather than by widget, so
+    # the canvas survives the bubble being rebuilt with the same content.
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._canvases = OrderedDict()
+        self._keys = {}  # (content hash, role) -> keys of its canvases
+
+    def get(self, key):
+        canvas = self._canvases.get(key)
+        if canvas is not None:
+            self._canvases.move_to_end(key)
+        return canvas
+
+    def put(self, key, canvas):
+        self._canvases[key] = canvas
+        self._keys.setdefault(key[:2], set()).add(key)
+        while len(self._canvases) > self.max_entries:
+            old_key, _ = self._canvases.popitem(last=False)
+            self._forget(old_key)
+
+    def _forget(self, key):
+        keys = self._keys.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[:2]]
+
+    def invalidate(self, content_hash, role):
+        for key in self._keys.pop((content_hash, role), ()):
+            self._canvases.pop(key, None)
+
+    def clear(self):
+        self._canvases.clear()
+        self._keys.clear()
+
+bubble_canvases = BubbleCanvasCache()
+
 class ChatBubble(WidgetWrap):
 
-    def __init__(self, content, role):
+    def __init__(self, content, role, truncated=False, width=None, incomplete=False, branch=None):
+        self.content_hash = hash(content)
+        self.role = role
+        self.status = "incomplete" if incomplete else "truncated" if truncated else ""
+        if branch is not None:
+            # < and > switch between the branches
+            self.status = f"<{branch[0] + 1}/{branch[1]}> {self.status}".strip()
         text = Text(content)
         text_attr = AttrMap(text, role, focus_map='focus')
-        text_bubble = LineBox(text_attr, **blocky_border_chars) # type: ignore
+        title = self.status
+        text_bubble = LineBox(text_attr, title=title, title_align="right", **blocky_border_chars) # type: ignore
         text_bubble_attr = AttrMap(text_bubble, "border", focus_map='border_focus')
 
         align = {"user": "right", "assistant": "left"}.get(role, "center")
 
-        max_width = int(raw_display.Screen().get_cols_rows()[0] * 0.7)
+        width = width or default_width
+        max_width = int(width.get() * 0.7)
         text_len = max(len(line) for line in content.splitlines()) if content else 0
 
 
-        if text_len <= max_width:
+        self.clip = text_len <= max_width
+        # wide enough to show the title next to the border corners
+        title_width = len(title) + 6 if title else 0
+        if self.clip and text_len + 2 < title_width:
+            padded_text_bubble = Padding(text_bubble_attr, align=align, width=title_width) # type: ignore
+        elif self.clip:
             padded_text_bubble = Padding(text_bubble_attr, align=align, width="clip") # type: ignore
         else:
             padded_text_bubble = Padding(text_bubble_attr, align=align, width=('relative', 70)) # type: ignore
 
         super().__init__(padded_text_bubble)
 
+    def render(self, size, focus=False):
+        key = (self.content_hash, self.role, self.status, self.clip, size, focus)
+        canvas = bubble_canvases.get(key)
+        if canvas is None:
+            canvas = super().render(size, focus)
+            bubble_canvases.put(key, canvas)
+        return canvas
+
+    def invalidate(self):
+        bubble_canvases.invalidate(self.content_hash, self.role)
+
+    def selectable(self):
+        return True
+
+class StreamingChatBubble(WidgetWrap):
+    # Bubble for a response that is still arriving. Finished lines are frozen
+    # into their own Text widgets so appending a chunk only re-wraps the tail.
+
+    def __init__(self, content, role):
+        self.chunks = []
+        self.tail = Text("")
+        self.pile = Pile([self.tail])
+        text_attr = AttrMap(self.pile, role, focus_map='focus')
+        text_bubble = LineBox(text_attr, **blocky_border_chars) # type: ignore
+        text_bubble_attr = AttrMap(text_bubble, "border", focus_map='border_focus')
+
+        align = {"user": "right", "assistant": "left"}.get(role, "center")
+        padded_text_bubble = Padding(text_bubble_attr, align=align, width=('relative', 70)) # type: ignore
+
+        super().__init__(padded_text_bubble)
+        if content:
+            self.append(content)
+
+    def append(self, chunk):
+        if not chunk:
+            return
+        self.chunks.append(chunk)
+        *finished, rest = chunk.split("\n")
+        if finished:
+            finished[0] = self.tail.text + finished[0]
+            for line in finished:
+                self.pile.contents.insert(len(self.pile.contents) - 1, (Text(line), self.pile.options()))
+            self.tail.set_text(rest)
+        else:
+            self.tail.set_text(self.tail.text + chunk)
+
+    def get_text(self):
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
     def selectable(self):
         return True
 
@@ -61,14 +185,23 @@ class ChatEdit(WidgetWrap):
         return True
 
 class EditableChatBubble(WidgetPlaceholder):
-    def __init__(self, content, role):
+    def __init__(self, content, role, truncated=False, width=None, incomplete=False, branch=None):
         self.content = content
         self.role = role
-        self.chat_bubble = ChatBubble(content, role)
+        self.truncated = truncated
+        self.incomplete = incomplete
+        self.branch = branch
+        self.width = width
+        self.chat_bubble = self._make_bubble()
         self.last_edit_position = 0
         super().__init__(self.chat_bubble) # type: ignore
 
+    def _make_bubble(self):
+        return ChatBubble(self.content, self.role, self.truncated, self.width, self.incomplete, self.branch)
+
     def enter_insert_mode(self, edit_pos=None):
+        if self.is_streaming():
+            return
         if not isinstance(self.original_widget, ChatEdit):
             self.original_widget = ChatEdit(self.content, self.role)
             if edit_pos == "start":
@@ -83,14 +216,38 @@ class EditableChatBubble(WidgetPlaceholder):
         if isinstance(self.original_widget, ChatEdit):
             self.content = self.original_widget.edit.edit_text
             self.last_edit_position = self.original_widget.edit.edit_pos
-            self.original_widget = ChatBubble(self.content, self.role)
+            # the text that was edited won't be shown again
+            self.chat_bubble.invalidate()
+            self.chat_bubble = self.original_widget = self._make_bubble()
 
     def in_insert_mode(self):
         return isinstance(self.original_widget, ChatEdit)
 
+    def start_stream(self):
+        self.original_widget = StreamingChatBubble(self.content, self.role)
+
+    def append(self, chunk):
+        self.original_widget.append(chunk)
+
+    def finish_stream(self, truncated=False, incomplete=False):
+        if self.is_streaming():
+            self.content = self.original_widget.get_text()
+            self.truncated = truncated
+            self.incomplete = incomplete
+            self.chat_bubble = self.original_widget = self._make_bubble()
+
+    def is_streaming(self):
+        return isinstance(self.original_widget, StreamingChatBubble)
+
     def update(self):
-        cls = type(self.original_widget)
-        self.original_widget = cls(self.content, self.role)
+        if self.is_streaming():
+            # relative width already follows the terminal
+            return
+        if isinstance(self.original_widget, ChatEdit):
+            self.original_widget = ChatEdit(self.content, self.role)
+        else:
+            self.chat_bubble.invalidate()
+            self.chat_bubble = self.original_widget = self._make_bubble()
 
     def selectable(self):
         return True
@@ -98,10 +255,21 @@ class EditableChatBubble(WidgetPlaceholder):
     def get_content(self):
         if isinstance(self.original_widget, ChatEdit):
             return self.original_widget.edit.edit_text
+        elif self.is_streaming():
+            return self.original_widget.get_text()
         else:
             return self.content
 
     def to_dict(self):
+        message = self.to_message()
+        if self.truncated:
+            message['truncated'] = True
+        if self.incomplete or self.is_streaming():
+            message['incomplete'] = True
+        return message
+
+    def to_message(self):
+        # what gets sent to the model, without UI-only flags
         return {
                 'content':self.get_content(),
                 'role': self.role
@@ -109,13 +277,18 @@ class EditableChatBubble(WidgetPlaceholder):
 
 
 class ChatHistory(ListBox):
-    def __init__(self, messages=None):
-        if messages is None or len(messages) == 0:
-            first_message = EditableChatBubble(content="", role="user")
-            self.message_list = SimpleListWalker([first_message])
+    def __init__(self, messages=None, width=None, max_widgets=256, on_change=None, undo_depth=100):
+        self.width = width or default_width
+        # bubbles are only built for messages that come into view
+        self.message_list = MessageWalker(messages or [], self._make_widget, max_widgets=max_widgets,
+                                          undo_depth=undo_depth)
+        if on_change is not None:
+            self.message_list.listeners.append(on_change)
+        if len(self.message_list) == 0:
+            first_message = self.message_list.append(self.new_record())
             first_message.enter_insert_mode(edit_pos="start")
-        else:
-            self.message_list = SimpleListWalker(self._build_message_widgets(messages))
+            # the draft is not something to undo
+            self.message_list.history.clear()
         super().__init__(self.message_list)  # Initialize ListBox before using its methods
 
         last_index = len(self.message_list) - 1
@@ -133,21 +306,86 @@ class ChatHistory(ListBox):
             return self.focus.in_insert_mode()
         return False
 
-    def _build_message_widgets(self, messages):
-        widgets = []
-        for msg in messages:
-            role = msg.get('role')
-            content = msg.get('content')
-            chat_bubble = EditableChatBubble(content=content, role=role)
-            widgets.append(chat_bubble)
-        return widgets
+    def is_locked(self, index):
+        # still being loaded from the chat file
+        return index < self.message_list.frozen
+
+    def new_record(self, content="", role="user", **flags):
+        return {'content': content, 'role': role, **flags}
+
+    def _make_widget(self, record):
+        return EditableChatBubble(
+            content=record.get('content', ''),
+            role=record.get('role', 'user'),
+            truncated=record.get('truncated', False),
+            width=self.width,
+            incomplete=record.get('incomplete', False),
+            branch=branches(record),
+        )
+
+    def insert_message(self, index, content="", role="user", **flags):
+        return self.message_list.insert(index, self.new_record(content, role, **flags))
+
+    def append_message(self, content="", role="user", **flags):
+        return self.message_list.append(self.new_record(content, role, **flags))
+
+    def update_message(self, index, **fields):
+        return self.message_list.update(index, **fields)
+
+    def edit_message(self, index, content):
+        # a changed message with others after it starts a new branch there,
+        # the old one keeps the original and its answers
+        walker = self.message_list
+        record = as_dict(walker.records[index])
+        if content == record.get('content'):
+            return
+        if index < len(walker) - 1 and not walker.frozen and not walker.is_streaming():
+            self.fork_message(index, content, record.get('role', 'user'))
+            self.set_focus(index)
+        else:
+            self.update_message(index, content=content)
+
+    def fork_message(self, index, content="", role="user", **flags):
+        # replaces everything from index on, which is kept as a branch
+        return self.message_list.fork(index, self.new_record(content, role, **flags))
+
+    def cycle_branch(self, delta):
+        # show the next or previous branch at the focused message
+        index = self.focus_position
+        walker = self.message_list
+        if self.in_insert_mode() or walker.frozen or walker.is_streaming():
+            return
+        branch = walker.branches(index)
+        if branch is None:
+            return
+        current, total = branch
+        walker.cycle(index, (current + delta) % total)
+        self.set_focus(index)
 
     def to_dict(self):
-        return [msg.to_dict() for msg in self.message_list]
+        return self.message_list.to_dicts()
+
+    def to_messages(self):
+        messages = []
+        for msg in self.to_dict():
+            msg = as_dict(msg)
+            messages.append({'content': msg.get('content', ''), 'role': msg.get('role', 'user')})
+        return messages
 
     def rebuild(self):
-        for message in self.message_list:
-            message.update()
+        # only bubbles that get drawn are re-laid out, the rest when they
+        # scroll into view
+        self.message_list.invalidate_layout()
+
+    def undo(self, redo=False):
+        # returns whether anything changed
+        if self.in_insert_mode():
+            return False
+        index = self.message_list.redo() if redo else self.message_list.undo()
+        if index is None:
+            return False
+        self.set_focus(min(index, len(self.message_list) - 1))
+        return True
 
     def delete_message(self, index):
         if 0 <= index < len(self.message_list):
@@ -162,6 +400,7 @@ class ChatHistory(ListBox):
             if self.focus.in_insert_mode():
                 if key == 'esc':
                     self.focus.leave_insert_mode()
+                    self.edit_message(self.focus_position, self.focus.content)
                     return None
                 else:
                     return self.focus.keypress(size, key)
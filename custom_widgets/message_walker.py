@@ -0,0 +1,343 @@
+from collections import OrderedDict, deque
+
+from urwid import ListWalker
+
+from storage.index import RawMessage
+from storage import ops
+from storage.ops import updated_record
+
+
+class UndoHistory:
+    """
+    Undo and redo stacks of inverse ops, at most `depth` steps each.
+
+    A step is the list of ops that reverts one change. Records are immutable
+    and shared with the walker, so a step costs the same whatever the size
+    of the chat: deleting a message keeps a reference to its record, an
+    update the record it replaced.
+    """
+
+    def __init__(self, depth=100):
+        self.undo = deque(maxlen=depth)
+        self.redo = deque(maxlen=depth)
+
+    def clear(self):
+        self.undo.clear()
+        self.redo.clear()
+
+
+class MessageWalker(ListWalker):
+    """
+    ListWalker that keeps the conversation as plain message dicts and only
+    builds bubble widgets for positions the ListBox actually asks for.
+
+    Records are never mutated in place: update() swaps in a new dict, so a
+    record can be used as the identity of its widget in the cache. At most
+    max_widgets widgets are kept alive, least recently used first out, except
+    for the focused one and any that are being edited or streamed into.
+
+    invalidate_layout() marks every live widget as stale without touching it;
+    stale widgets are re-laid out when the ListBox next asks for them, so only
+    what is on screen pays for a resize.
+
+    Every change is reported to the callables in listeners as an op dict
+    (see storage.ops), which is what gets written to the chat journal.
+
+    While a chat file is loaded in the background, load() puts the parsed
+    messages in front of everything else. The first `frozen` records are
+    the ones loaded so far and must not be changed until finish_loading().
+
+    Changes can be reverted with undo() and redo(), which apply the inverse
+    ops through the same methods, so they are journaled like any other
+    change. Text streamed into a message with append_text() is part of the
+    step that created or reset that message.
+    """
+
+    def __init__(self, messages, make_widget, max_widgets=256, undo_depth=100):
+        # may hold RawMessages from a memory-mapped file, decoded on first use
+        self.records = list(messages)
+        self.make_widget = make_widget
+        self.max_widgets = max_widgets
+        self._widgets = OrderedDict()  # id(record) -> (record, widget, layout)
+        self._layout = 0
+        self.listeners = []
+        self.focus = max(len(self.records) - 1, 0)
+        self.frozen = 0
+        self.history = UndoHistory(undo_depth)
+        self._undoing = None  # the stack inverse ops go to, None: a new change
+
+    def __len__(self):
+        return len(self.records)
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self.records)
+        if not 0 <= index < len(self.records):
+            raise IndexError(index)
+        return index
+
+    def _record(self, index):
+        record = self.records[index]
+        if isinstance(record, RawMessage):
+            record = self.records[index] = record.decode()
+        return record
+
+    def __getitem__(self, index):
+        record = self._record(self._index(index))
+        key = id(record)
+        if key in self._widgets:
+            self._widgets.move_to_end(key)
+            _record, widget, layout = self._widgets[key]
+            if layout != self._layout:
+                if not widget.in_insert_mode():
+                    # the editor follows the width by itself, keep its text
+                    widget.update()
+                self._widgets[key] = (record, widget, self._layout)
+            return widget
+        widget = self.make_widget(record)
+        self._widgets[key] = (record, widget, self._layout)
+        self._evict()
+        return widget
+
+    def invalidate_layout(self):
+        self._layout += 1
+        self._modified()
+
+    def _evict(self):
+        if len(self._widgets) <= self.max_widgets:
+            return
+        focus_key = id(self.records[self.focus]) if self.records else None
+        for key, (_record, widget, _layout) in list(self._widgets.items()):
+            if len(self._widgets) <= self.max_widgets:
+                break
+            if key == focus_key or widget.in_insert_mode() or widget.is_streaming():
+                continue
+            del self._widgets[key]
+
+    def next_position(self, position):
+        if position + 1 >= len(self.records):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self.records) - 1, -1, -1)
+        return range(len(self.records))
+
+    def set_focus(self, position):
+        self.focus = self._index(position)
+        self._modified()
+
+    def _notify(self, op, inverse):
+        self._remember(op, inverse)
+        for listener in self.listeners:
+            listener(op)
+
+    def _remember(self, op, inverse):
+        if self._undoing is not None:
+            self._undoing.append([inverse])
+            return
+        stack = self.history.undo
+        if op["op"] == "append" and stack and stack[-1][-1].get("index") == op["index"]:
+            # streamed text goes with the step that started the answer
+            return
+        stack.append([inverse])
+        self.history.redo.clear()
+
+    def _revert(self, source, target):
+        # apply the newest step from source, its inverse goes to target
+        if not source or self.frozen or self.is_streaming():
+            return None
+        step = source.pop()
+        self._undoing = []
+        try:
+            for op in reversed(step):
+                self.apply(op)
+        finally:
+            inverse, self._undoing = self._undoing, None
+        target.append([op for ops in inverse for op in ops])
+        return step[-1]["index"]
+
+    def undo(self):
+        # returns the position that changed, None if there was nothing to do
+        return self._revert(self.history.undo, self.history.redo)
+
+    def redo(self):
+        return self._revert(self.history.redo, self.history.undo)
+
+    def is_streaming(self):
+        return any(widget.is_streaming() for _record, widget, _layout in self._widgets.values())
+
+    def apply(self, op):
+        kind = op["op"]
+        if kind == "insert":
+            self.insert(op["index"], op["message"])
+        elif kind == "delete":
+            del self[op["index"]]
+        elif kind == "swap":
+            self.swap(op["index"], op["other"])
+        elif kind == "update":
+            self.update(op["index"], **{k: v for k, v in op.items() if k not in ("op", "index")})
+        elif kind == "splice":
+            self.splice(op["index"], op["messages"])
+        else:
+            raise ValueError(f"unknown op {kind!r}")
+
+    def cached(self, record):
+        entry = self._widgets.get(id(record))
+        return entry[1] if entry is not None else None
+
+    def position_of(self, widget):
+        for record, cached, _layout in self._widgets.values():
+            if cached is widget:
+                for i, candidate in enumerate(self.records):
+                    if candidate is record:
+                        return i
+        raise ValueError("widget is not part of this walker")
+
+    def load(self, start, records):
+        # replace records[start:frozen] with loaded records, not reported as
+        # a change
+        for record in self.records[start:self.frozen]:
+            self._widgets.pop(id(record), None)
+        end = start + len(records)
+        if self.focus >= self.frozen:
+            self.focus += end - self.frozen
+        self.records[start:self.frozen] = records
+        self.frozen = end
+        self.focus = min(self.focus, max(len(self.records) - 1, 0))
+        self._modified()
+
+    def finish_loading(self):
+        self.frozen = 0
+        # positions in steps taken while loading are off
+        self.history.clear()
+
+    def insert(self, index, record):
+        index = min(max(index, 0), len(self.records))
+        record = dict(record)
+        self.records.insert(index, record)
+        if self.focus >= index and len(self.records) > 1:
+            self.focus += 1
+        self._modified()
+        self._notify({"op": "insert", "index": index, "message": record}, {"op": "delete", "index": index})
+        return self[index]
+
+    def append(self, record):
+        return self.insert(len(self.records), record)
+
+    def __delitem__(self, index):
+        index = self._index(index)
+        self._record(index)
+        record = self.records.pop(index)
+        self._widgets.pop(id(record), None)
+        if self.focus > index or self.focus >= len(self.records):
+            self.focus = max(self.focus - 1, 0)
+        self._modified()
+        self._notify({"op": "delete", "index": index}, {"op": "insert", "index": index, "message": record})
+
+    def swap(self, i, j):
+        i, j = self._index(i), self._index(j)
+        self.records[i], self.records[j] = self.records[j], self.records[i]
+        self._modified()
+        self._notify({"op": "swap", "index": i, "other": j}, {"op": "swap", "index": i, "other": j})
+
+    def _set_suffix(self, index, suffix, op):
+        # replace records[index:], the inverse restores the old ones
+        self.sync_edits()
+        old = [self._record(i) for i in range(index, len(self.records))]
+        for record in old:
+            self._widgets.pop(id(record), None)
+        self.records[index:] = suffix
+        self.focus = min(self.focus, max(len(self.records) - 1, 0))
+        self._modified()
+        self._notify(op, {"op": "splice", "index": index, "messages": old})
+
+    def _suffix(self, index):
+        return [self._record(i) for i in range(index, len(self.records))]
+
+    def fork(self, index, record):
+        # continue with record at index, what was there becomes a branch
+        index = min(max(index, 0), len(self.records))
+        record = dict(record)
+        self.sync_edits()
+        suffix = self._suffix(index)
+        ops.fork(suffix, 0, record)
+        self._set_suffix(index, suffix, {"op": "fork", "index": index, "message": record})
+        return self[index]
+
+    def cycle(self, index, branch):
+        index = self._index(index)
+        self.sync_edits()
+        suffix = self._suffix(index)
+        ops.cycle(suffix, 0, branch)
+        self._set_suffix(index, suffix, {"op": "cycle", "index": index, "branch": branch})
+
+    def splice(self, index, records):
+        self._set_suffix(index, [dict(record) for record in records],
+                         {"op": "splice", "index": index, "messages": list(records)})
+
+    def branches(self, index):
+        return ops.branches(self._record(self._index(index)))
+
+    def update(self, index, **fields):
+        return self._replace(index, {**fields}, {"op": "update", "index": index, **fields})
+
+    def append_text(self, index, text, **fields):
+        index = self._index(index)
+        content = self._record(index).get('content', '') + text
+        return self._replace(index, {**fields, 'content': content}, {"op": "append", "index": index, "text": text, **fields})
+
+    def _replace(self, index, fields, op):
+        index = self._index(index)
+        old = self._record(index)
+        record = updated_record(old, fields)
+        if record == old:
+            # nothing to journal or undo
+            return old
+        self.records[index] = record
+
+        entry = self._widgets.pop(id(old), None)
+        if entry is not None:
+            widget = entry[1]
+            self._widgets[id(record)] = (record, widget, self._layout)
+            widget.content = record.get('content', '')
+            widget.role = record.get('role', 'user')
+            widget.truncated = record.get('truncated', False)
+            widget.incomplete = record.get('incomplete', False)
+            widget.branch = ops.branches(record)
+            widget.update()
+        self._modified()
+        # put back every field of the old record, None removes added ones
+        restore = {key: old.get(key) for key in {**old, **record}}
+        self._notify(op, {"op": "update", "index": index, **restore})
+        return record
+
+    def sync_edits(self):
+        # record text typed into bubbles that are still in insert mode
+        for index, record in enumerate(self.records):
+            widget = self.cached(record)
+            if widget is not None and widget.in_insert_mode():
+                content = widget.get_content()
+                if content != record.get('content'):
+                    self.update(index, content=content)
+
+    def to_dicts(self):
+        # Records are never changed in place, so a shallow copy of the list
+        # is a consistent snapshot; callers must not modify the dicts. It can
+        # contain RawMessages, see storage.index.as_dict.
+        result = list(self.records)
+        # widgets in insert mode or mid-stream hold content not yet in the record
+        live = {id(record): widget for record, widget, _layout in self._widgets.values()
+                if widget.in_insert_mode() or widget.is_streaming()}
+        if live:
+            for index, record in enumerate(result):
+                widget = live.get(id(record))
+                if widget is not None:
+                    result[index] = {**record, **widget.to_dict()}
+        return result
@@ -7,10 +7,13 @@ from custom_widgets.chat import ChatHistory, EditableChatBubble
 
 class VimKeyHandler(urwid.WidgetWrap):
     MAX_KEY_SEQ_LENGTH = 2
-    def __init__(self, chat_history, header=None, footer=None):
+    def __init__(self, chat_history, header=None, footer=None, on_insert=None):
         self.chat_history : ChatHistory = chat_history
         self.header = header
         self.footer = footer
+        # called on entering insert mode
+        self.on_insert = on_insert
+        self.insert_mode = False
 
         self.frame = urwid.Frame(
             body=chat_history,
@@ -38,6 +41,10 @@ class VimKeyHandler(urwid.WidgetWrap):
             ('c', ): self.clear_focused_message,
             ('d', 'd'): self.delete_focused_message,
             ('g', 'g'): self.go_to_first_message,
+            ('u',): self.chat_history.undo,
+            ('ctrl r',): lambda: self.chat_history.undo(redo=True),
+            ('<',): lambda: self.chat_history.cycle_branch(-1),
+            ('>',): lambda: self.chat_history.cycle_branch(1),
         }
 
         self.key_buffer = []
@@ -50,7 +57,7 @@ class VimKeyHandler(urwid.WidgetWrap):
         last_message = self.chat_history.message_list[-1]
         if idx > len(self.chat_history.message_list)-1:
             if last_message.get_content():
-                self.chat_history.message_list.append(EditableChatBubble(content="", role="user"))
+                self.chat_history.append_message()
             self.chat_history.set_focus(len(self.chat_history.message_list) - 1, coming_from='above')
         else:
             self.chat_history.set_focus(idx, coming_from='above')
@@ -62,6 +69,8 @@ class VimKeyHandler(urwid.WidgetWrap):
         self.chat_history.set_focus(idx, coming_from='above')
 
     def set_insert_mode(self, mode):
+        if mode and not self.insert_mode and self.on_insert is not None:
+            self.on_insert()
         self.insert_mode = mode
         if self.footer is not None:
             mode = "insert" if mode else "normal"
@@ -95,15 +104,20 @@ class VimKeyHandler(urwid.WidgetWrap):
 
     def enter_insert_mode(self, edit_position=None):
         if self.chat_history.focus is None:
-            edit_message = EditableChatBubble(content="", role="user")
-            self.chat_history.message_list.append(edit_message)
+            edit_message = self.chat_history.append_message()
             self.chat_history.set_focus(len(self.chat_history.message_list) - 1, coming_from='above')
         else:
+            if self.chat_history.is_locked(self.chat_history.focus_position):
+                return
             edit_message = self.chat_history.focus
 
+        assert(isinstance(edit_message, EditableChatBubble))
+        if edit_message.is_streaming():
+            # wait for the response to finish
+            return
+
         self.set_insert_mode(True)
 
-        assert(isinstance(edit_message, EditableChatBubble))
         if not edit_message.in_insert_mode():
             edit_message.enter_insert_mode(edit_position)
 
@@ -112,6 +126,8 @@ class VimKeyHandler(urwid.WidgetWrap):
     def delete_focused_message(self):
         try:
             idx = self.chat_history.focus_position
+            if self.chat_history.is_locked(idx):
+                return
             self.chat_history.delete_message(idx)
         except IndexError:
             pass
@@ -119,8 +135,10 @@ class VimKeyHandler(urwid.WidgetWrap):
     def clear_focused_message(self):
         if self.chat_history.focus is not None:
             assert(isinstance(self.chat_history.focus, EditableChatBubble))
+            if self.chat_history.focus.is_streaming() or self.chat_history.is_locked(self.chat_history.focus_position):
+                return
             self.set_insert_mode(True)
-            self.chat_history.focus.content = ""
+            self.chat_history.update_message(self.chat_history.focus_position, content="")
             self.chat_history.focus.enter_insert_mode()
 
     def go_to_first_message(self):
@@ -140,8 +158,9 @@ class VimKeyHandler(urwid.WidgetWrap):
         current_message = self.chat_history.focus
         if current_message is not None:
             assert(isinstance(current_message, EditableChatBubble))
-            current_message.role = role
-            current_message.update()
+            if self.chat_history.is_locked(self.chat_history.focus_position):
+                return
+            self.chat_history.update_message(self.chat_history.focus_position, role=role)
 
     def switch_message_to_assistant(self):
         self.switch_message_role("assistant")
@@ -155,10 +174,9 @@ class VimKeyHandler(urwid.WidgetWrap):
             idx = self.chat_history.focus_position
             new_idx = idx + delta
             if new_idx >= 0:
-                message = self.chat_history.message_list[idx]
-                prev_message = self.chat_history.message_list[new_idx]
-                self.chat_history.message_list[idx] = prev_message
-                self.chat_history.message_list[new_idx] = message
+                if self.chat_history.is_locked(min(idx, new_idx)):
+                    return
+                self.chat_history.message_list.swap(idx, new_idx)
                 self.chat_history.set_focus(new_idx, coming_from='above')
         except IndexError:
             pass
@@ -172,10 +190,11 @@ class VimKeyHandler(urwid.WidgetWrap):
 
 
     def add_message(self, index):
-        new_message = EditableChatBubble(content="", role="user")
-        self.chat_history.message_list.insert(index, new_message)
+        if self.chat_history.is_locked(index):
+            return
+        new_message = self.chat_history.insert_message(index)
         self.chat_history.set_focus(index, coming_from='above')
-        self.insert_mode = True
+        self.set_insert_mode(True)
         new_message.enter_insert_mode()
 
 
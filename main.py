@@ -1,11 +1,14 @@
 import argparse
 import os
-import subprocess
-import tempfile
+import sys
 
 import tomllib
 
-from app import ChatApp
+# Everything else is imported where it is used: this module is loaded by
+# every invocation, --help and config errors included, and the chat UI
+# alone takes longer to import than the rest of startup. See startup_report.
+
+DEFAULT_DATABASE = "~/.local/share/terminal_gpt/chats.db"
 
 
 def load_config():
@@ -20,6 +23,8 @@ def set_api_keys(config):
         api_key = value.get("api_key", None)
         api_key_cmd = value.get("api_key_cmd", None)
         if not api_key and api_key_cmd:
+            import subprocess
+
             try:
                 api_key = subprocess.check_output(api_key_cmd, shell=True).decode().strip()
             except subprocess.CalledProcessError:
@@ -29,14 +34,94 @@ def set_api_keys(config):
 
 
 def get_avaliable_models(config):
+    from models.registry import find_provider
+
     available_models = {}
     for provider, data in config["providers"].items():
-        if os.environ.get(f"{provider.upper()}_API_KEY"):
-            for model in data.get("models", []):
-                available_models[model] = {"provider": provider, "name": model}
+        kind = data.get("type", provider)
+        spec = find_provider(kind)
+        if spec is None:
+            print(f"Unknown provider type '{kind}' for [providers.{provider}], skipping it.")
+            continue
+        if spec.declares("api_key") and not os.environ.get(f"{provider.upper()}_API_KEY"):
+            continue
+        # everything else in the section configures the backend
+        options = {k: v for k, v in data.items() if k not in ("api_key", "api_key_cmd", "models", "type")}
+        for model in data.get("models", []):
+            available_models[model] = {"provider": provider, "name": model, "type": kind, "options": options}
     return available_models
 
 
+def configure_http(config):
+    # one connection pool for all providers, see models.http
+    from models import http
+
+    settings = config.get("http", {})
+    unknown = set(settings) - set(http.DEFAULTS)
+    if unknown:
+        print(f"Unknown [http] settings {', '.join(sorted(unknown))}, ignoring them.")
+    http.configure({k: v for k, v in settings.items() if k not in unknown})
+    if http.settings()["http2"] and not http.http2_available():
+        print("http2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1.")
+
+
+def get_blobs(config):
+    # "blobs = true" or "blobs = PATH" stores long messages once, by hash
+    blobs = config.get("blobs", False)
+    if blobs is False:
+        return None
+    from storage.blobs import DEFAULT_ROOT, BlobStore
+
+    return BlobStore(DEFAULT_ROOT if blobs is True else blobs)
+
+
+def export_chat(chat_file, path, blobs=None):
+    # with blobs, an exported copy shares the texts with the original
+    from storage import open_store
+    from storage.sqlite_store import SEPARATOR, split_path
+
+    messages = open_store(chat_file, blobs).load()
+    store = open_store(path, blobs, create=True)
+    store.save(messages)
+    store.close()
+    if split_path(path) is not None:
+        # the new conversation's id
+        print(f"{chat_file} -> {store.path}{SEPARATOR}{store.conversation}")
+
+
+def collect_garbage(blobs):
+    if blobs is None:
+        from storage.blobs import BlobStore
+
+        blobs = BlobStore()
+    removed, freed = blobs.gc()
+    print(f"Removed {removed} unreferenced blobs, freed {freed / 2**20:.1f} MiB.")
+
+
+def search_chats(database, query, limit):
+    from storage.sqlite_store import SEPARATOR, search
+
+    highlight = ('\033[1m', '\033[0m') if sys.stdout.isatty() else ('[', ']')
+    for conversation, position, role, snippet, title in search(database, query, limit, highlight):
+        snippet = " ".join(snippet.split())
+        print(f"{database}{SEPARATOR}{conversation}  {title}")
+        print(f"    [{position}] {role}: {snippet}")
+
+
+def import_chats(database, paths, blobs=None):
+    from storage import load_messages
+    from storage.sqlite_store import SEPARATOR, import_chat
+
+    for path in paths:
+        try:
+            messages = load_messages(path, blobs=blobs)
+        except (OSError, ValueError) as e:
+            print(f"Skipping {path}: {e}")
+            continue
+        conversation = import_chat(database, messages, source=os.path.abspath(path))
+        print(f"{path} -> {database}{SEPARATOR}{conversation}")
+
+
 def main():
     ## argument parsing
     parser = argparse.ArgumentParser(description="Chat application with message history.")
@@ -44,11 +129,61 @@ def main():
                         help='Path to the chat history file (default: temp directory)')
     parser.add_argument('--model', type=str, default='gpt-4.1-mini', 
                         help='Model to use for chat (default: gpt-4.1-mini)')
+    parser.add_argument('--export', type=str, default=None, metavar='PATH',
+                        help='Write the chat file to PATH (.json, .json.gz/.xz/.bz2, .jsonl or DB.db#ID) and exit')
+    parser.add_argument('--database', type=str, default=None, metavar='PATH',
+                        help='SQLite chat database for new chats, search and import (default: from config)')
+
+    commands = parser.add_subparsers(dest='command')
+    search_parser = commands.add_parser('search', help='Full-text search over the chats in the database')
+    search_parser.add_argument('query', nargs='+')
+    search_parser.add_argument('--limit', type=int, default=20)
+    import_parser = commands.add_parser('import', help='Copy chat files into the database')
+    import_parser.add_argument('paths', nargs='+', metavar='FILE')
+    commands.add_parser('gc', help='Delete message blobs no chat file refers to, including unopened chats next to known ones')
+    startup_parser = commands.add_parser('startup', help='Report import times against the startup budget')
+    startup_parser.add_argument('--runs', type=int, default=5, help='Keep the fastest of N runs (default: 5)')
+    startup_parser.add_argument('--top', type=int, default=10, help='Show the N slowest modules (default: 10)')
 
     args = parser.parse_args()
 
     config = load_config()
+    blobs = get_blobs(config)
+
+    if args.export is not None:
+        if args.chat_file is None:
+            print("--export needs --chat-file.")
+            return
+        try:
+            export_chat(args.chat_file, args.export, blobs)
+        except (OSError, ValueError) as e:
+            print(f"Export failed: {e}")
+        return
+
+    if args.command == 'startup':
+        from startup_report import report
+
+        if not report(config.get("startup_budget", {}), args.runs, args.top):
+            sys.exit(1)
+        return
+
+    if args.command == 'gc':
+        collect_garbage(blobs)
+        return
+    database = args.database or config.get("database")
+    if database is not None:
+        database = os.path.expanduser(database)
+
+    if args.command is not None:
+        database = database or os.path.expanduser(DEFAULT_DATABASE)
+        if args.command == 'search':
+            search_chats(database, " ".join(args.query), args.limit)
+        else:
+            import_chats(database, args.paths, blobs)
+        return
+
     set_api_keys(config)
+    configure_http(config)
     available_models = get_avaliable_models(config)
 
     model_name = args.model if args.model else config.get("default_model", "gpt-4.1-mini")
@@ -63,22 +198,48 @@ def main():
         return
 
     # Check if the chat file exists, if not, create a temporary one
-    if args.chat_file is None:
+    if args.chat_file is None and database is not None:
+        # new conversation in the chat database
+        from storage.sqlite_store import new_chat
+
+        chat_file = new_chat(database)
+    elif args.chat_file is None:
+        import tempfile
+
         try:
             base_temp_dir = tempfile.gettempdir()
             subfolder = 'terminal_gpt_chats'
             temp_dir = os.path.join(base_temp_dir, subfolder)
             os.makedirs(temp_dir, exist_ok=True)
-            tf = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir, suffix='.json')
+            tf = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir, suffix='.jsonl')
             chat_file = tf.name
             tf.close()  # Close the file so it can be used elsewhere
         except Exception:
             print("Failed to create a temporary chat file. Please specify a valid chat file path.")
             return
     else:
+        from storage.sqlite_store import SEPARATOR, split_path
+
         chat_file = args.chat_file
+        database_file = split_path(chat_file)
+        if database_file is not None and database_file[1] is None:
+            print(f"{chat_file} holds many chats: open one as {chat_file}{SEPARATOR}ID, or use --database for a new one.")
+            return
+        if database_file is not None:
+            from storage import open_store
+
+            try:
+                open_store(chat_file).close()
+            except (OSError, ValueError) as e:
+                print(f"Error: {e}")
+                return
+
+    metrics_log = os.path.expanduser(config.get("metrics_log", "~/.local/state/terminal_gpt/metrics.jsonl"))
+
+    from app import ChatApp
 
-    app = ChatApp(chat_file, model, available_models)
+    app = ChatApp(chat_file, model, available_models, max_fps=config.get("max_fps", 30), metrics_log=metrics_log,
+                  blobs=blobs)
     app.run()
     app.shutdown()
 
@@ -0,0 +1,91 @@
+import threading
+
+# httpx is imported when the first provider is created, not with this
+# module: main.py configures the pool before anything is known to need it.
+
+# Settings of the [http] table in config.toml
+DEFAULTS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    # httpx drops idle connections after 5 s, well before anyone has typed
+    # a question; see models.prewarm
+    "keepalive_expiry": 60.0,
+    # needs the h2 package (pip install httpx[http2])
+    "http2": False,
+    "connect_timeout": 10.0,
+    # between two chunks of an answer; None waits forever
+    "read_timeout": 600.0,
+    "write_timeout": 30.0,
+    # for a free connection when max_connections are in use
+    "pool_timeout": 30.0,
+}
+
+_settings = dict(DEFAULTS)
+_client = None
+_lock = threading.Lock()
+
+
+def configure(settings):
+    """
+    Set up the shared pool from the [http] table, before the first provider
+    is created. Raises ValueError for unknown settings.
+    """
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown [http] settings: {', '.join(sorted(unknown))}")
+    _settings.update(settings)
+
+
+def settings():
+    return dict(_settings)
+
+
+def http2_available():
+    import importlib.util
+
+    return importlib.util.find_spec("h2") is not None
+
+
+def shared_client():
+    """
+    The one httpx.AsyncClient all providers send through, so every model and
+    provider talking to the same host reuses its connections. Requests use
+    absolute URLs. Safe to call from provider factories in worker threads;
+    its connections belong to the event loop that first used them, so
+    aclose() it before switching loops.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = new_client()
+        return _client
+
+
+def new_client():
+    import httpx
+
+    return httpx.AsyncClient(
+        # without h2 the chat works the same over HTTP/1.1
+        http2=_settings["http2"] and http2_available(),
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=_settings["max_connections"],
+            max_keepalive_connections=_settings["max_keepalive_connections"],
+            keepalive_expiry=_settings["keepalive_expiry"],
+        ),
+        timeout=httpx.Timeout(
+            connect=_settings["connect_timeout"],
+            read=_settings["read_timeout"],
+            write=_settings["write_timeout"],
+            pool=_settings["pool_timeout"],
+        ),
+    )
+
+
+async def aclose():
+    # close the pool; the next shared_client() starts a new one
+    global _client
+    with _lock:
+        client, _client = _client, None
+    if client is not None:
+        await client.aclose()
@@ -1,8 +1,15 @@
-def get_completion(model: dict):
-    provider = model.get("provider", None)
-    if provider == "openai":
-        from models.openai import complete as openai_complete
-        return openai_complete
-    else:
-        raise ValueError(f"Unsupported provider: {provider}")
+from models.prewarm import prewarm
+from models.registry import get_completion
 
+
+CONTINUE_PROMPT = "Continue your previous answer exactly where it stopped. Do not repeat any of it."
+
+def continuation_messages(messages, partial):
+    # ask the model to pick up an answer that was cut off
+    if len(messages) >= 2 and messages[-1] == {"role": "user", "content": CONTINUE_PROMPT}:
+        # already a continuation that was cut off in turn, extend it
+        messages, partial = messages[:-2], messages[-2]["content"] + partial
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
@@ -0,0 +1,109 @@
+import json
+import os
+import time
+
+
+class StreamStats:
+    # Timing of one streamed completion. The caller records every delta;
+    # providers that report usage fill in completion_tokens, and retries
+    # are reported to retry() and from there to on_retry(stats).
+    def __init__(self, model, provider, on_retry=None):
+        self.model = model
+        self.provider = provider
+        self.started = time.time()
+        self._start = time.monotonic()
+        self._first_delta = None
+        self._end = None
+        self.deltas = 0
+        self.chars = 0
+        self.completion_tokens = None
+        self.cancelled = False
+        self.retries = 0
+        self.error = None  # why the answer stopped short, if it did
+        self.on_retry = on_retry
+        self._retry_at = None
+        self._last_error = None
+
+    def record(self, delta):
+        self._retry_at = None
+        if self._first_delta is None:
+            self._first_delta = time.monotonic()
+        self.deltas += 1
+        self.chars += len(delta)
+
+    def retry(self, error, delay):
+        self.retries += 1
+        self._retry_at = time.monotonic() + delay
+        self._last_error = describe_error(error)
+        if self.on_retry is not None:
+            self.on_retry(self)
+
+    def finish(self, cancelled=False):
+        self._end = time.monotonic()
+        self.cancelled = cancelled
+
+    @property
+    def ttft(self):
+        if self._first_delta is None:
+            return None
+        return self._first_delta - self._start
+
+    @property
+    def tokens(self):
+        if self.completion_tokens is not None:
+            return self.completion_tokens
+        # rough estimate until the provider reports usage
+        return self.chars / 4
+
+    @property
+    def tokens_per_second(self):
+        if self._first_delta is None:
+            return None
+        end = self._end if self._end is not None else time.monotonic()
+        duration = end - self._first_delta
+        if duration <= 0:
+            return None
+        return self.tokens / duration
+
+    def summary(self):
+        if self._retry_at is not None:
+            wait = max(self._retry_at - time.monotonic(), 0)
+            return f"{self._last_error}, retry {self.retries} in {wait:.1f}s"
+        if self.ttft is None:
+            return "waiting…"
+        text = f"ttft {self.ttft:.2f}s"
+        if self.tokens_per_second is not None:
+            text += f"  {self.tokens_per_second:.0f} tok/s"
+        if self.retries:
+            text += f"  {self.retries} retries"
+        return text
+
+    def to_dict(self):
+        return {
+            "time": self.started,
+            "model": self.model,
+            "provider": self.provider,
+            "ttft": self.ttft,
+            "duration": (self._end or time.monotonic()) - self._start,
+            "deltas": self.deltas,
+            "chars": self.chars,
+            "completion_tokens": self.completion_tokens,
+            "tokens_per_second": self.tokens_per_second,
+            "cancelled": self.cancelled,
+            "retries": self.retries,
+            "error": self.error,
+        }
+
+
+def describe_error(error):
+    # one short line for the footer and the metrics log
+    lines = str(error).strip().splitlines()
+    text = f"{type(error).__name__}: {lines[0]}" if lines else type(error).__name__
+    return text if len(text) <= 80 else text[:79] + "…"
+
+
+def log_metrics(stats, path):
+    # one JSON object per line so runs can be compared with any tool
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(stats.to_dict()) + "\n")
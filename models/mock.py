@@ -0,0 +1,27 @@
+import asyncio
+import re
+from typing import AsyncIterator
+
+
+def create(name, options):
+    """
+    Deterministic answers without a network, for trying things out and for
+    benchmarks. Options:
+
+        reply  template for the answer, {prompt} is the last user message,
+               {model} the model name; defaults to "You said: {prompt}"
+        delay  seconds between streamed words, defaults to 0.02
+    """
+    reply = options.get("reply", "You said: {prompt}")
+    delay = options.get("delay", 0.02)
+
+    async def complete(model, messages, stats=None) -> AsyncIterator[str]:
+        prompt = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        words = re.findall(r"\s*\S+\s*", reply.format(prompt=prompt, model=model)) or [""]
+        for word in words:
+            if delay:
+                await asyncio.sleep(delay)
+            yield word
+        if stats is not None:
+            stats.completion_tokens = len(words)
+    return complete
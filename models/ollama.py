@@ -0,0 +1,56 @@
+import json
+from typing import AsyncIterator
+
+import httpx
+
+from models.http import shared_client
+from models.prewarm import Prewarmer
+from models.retry import MAX_RETRIES, status_delay, with_retries
+
+
+def retry_delay(error):
+    # see models.retry.with_retries
+    if isinstance(error, httpx.HTTPStatusError):
+        return status_delay(error.response.status_code, error.response.headers)
+    if isinstance(error, httpx.TransportError):
+        return 0.0
+    return None
+
+
+def create(name, options):
+    """
+    Ollama's native streaming chat API, one JSON object per line. Options:
+
+        base_url    defaults to http://localhost:11434
+        keep_alive  how long the server keeps the model loaded, e.g. "30m"
+        options     model parameters passed through, e.g. {num_ctx = 8192}
+        max_retries retries after a failed request, defaults to 4
+    """
+    # loading a big model takes a while, mind read_timeout in [http]
+    client = shared_client()
+    base_url = options.get("base_url", "http://localhost:11434").rstrip("/")
+    extra = {key: options[key] for key in ("keep_alive", "options") if key in options}
+
+    async def complete(model, messages, stats=None) -> AsyncIterator[str]:
+        body = {"model": model, "messages": messages, "stream": True, **extra}
+        # leaving the block on close or cancel drops the connection
+        async with client.stream("POST", f"{base_url}/api/chat", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise httpx.HTTPStatusError(f"ollama: {response.status_code} {response.text}",
+                                            request=response.request, response=response)
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(f"ollama: {chunk['error']}")
+                if content := chunk.get("message", {}).get("content"):
+                    yield content
+                # the last line; reading on to the end of the body keeps the
+                # connection in the pool
+                if chunk.get("done") and stats is not None and "eval_count" in chunk:
+                    stats.completion_tokens = chunk["eval_count"]
+    complete = with_retries(complete, retry_delay, options.get("max_retries", MAX_RETRIES))
+    complete.prewarm = Prewarmer(lambda: client.get(f"{base_url}/api/version"))
+    return complete
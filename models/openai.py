@@ -1,39 +1,100 @@
-from typing import Iterator
+import os
+from typing import AsyncIterator
 
-from openai import OpenAI
+import httpx
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
 
-# you can share one client across calls
-client = OpenAI()
+from models.http import shared_client
+from models.prewarm import Prewarmer
+from models.retry import MAX_RETRIES, status_delay, with_retries
 
-def complete(
+
+def client_options():
+    # send through the shared pool, with its timeouts instead of the SDK's;
+    # retries are up to models.retry, which can also resume a broken stream
+    client = shared_client()
+    return {"http_client": client, "timeout": client.timeout, "max_retries": 0}
+
+
+def retry_delay(error):
+    # see models.retry.with_retries
+    if isinstance(error, APIStatusError):
+        return status_delay(error.status_code, error.response.headers)
+    # dropped mid-stream, the SDK lets httpx errors through
+    if isinstance(error, (APIConnectionError, httpx.TransportError)):
+        return 0.0
+    return None
+
+
+def prewarmer(client):
+    # listing models is the cheapest authenticated request
+    return Prewarmer(lambda: client.models.list())
+
+
+def create(name, options):
+    # provider factory, see models.registry; one client shared across calls.
+    # main.py puts the section's key in {NAME}_API_KEY
+    client = AsyncOpenAI(
+        api_key=os.environ.get(f"{name.upper()}_API_KEY"),
+        base_url=options.get("base_url"),
+        **client_options(),
+    )
+
+    def complete(model: str, messages, stats=None) -> AsyncIterator[str]:
+        return stream_chat(client, model, messages, stats)
+    complete = with_retries(complete, retry_delay, options.get("max_retries", MAX_RETRIES))
+    complete.prewarm = prewarmer(client)
+    return complete
+
+
+async def stream_chat(
+    client: AsyncOpenAI,
     model: str,
     messages,
-) -> Iterator[str]:
+    stats=None,
+    usage=True,
+) -> AsyncIterator[str]:
     """
-    Stream-complete a chat-based model via the new OpenAI client.
+    Stream-complete a chat-based model via an async OpenAI client.
     Yields each text delta as it arrives.
 
     Args:
-        model: The name of the model (e.g. "gpt-4.1")
+        client:   The AsyncOpenAI client, also used for compatible servers.
+        model:    The name of the model (e.g. "gpt-4.1")
         messages: List of {"role": ..., "content": ...} dicts.
-        client:   (optional) an existing OpenAI client instance.
+        stats:    (optional) a StreamStats that receives the token usage.
+        usage:    Whether the server accepts stream_options.
 
     Yields:
         Each subsequent piece of generated text (str).
     """
-    stream = client.chat.completions.create(
+    options = {}
+    if stats is not None and usage:
+        # usage arrives in one extra chunk after the last delta
+        options["stream_options"] = {"include_usage": True}
+
+    stream = await client.chat.completions.create(
         model=model,
         messages=messages,
-        stream=True
+        stream=True,
+        **options,
     )
 
-    for chunk in stream:
-        # chunk.choices[0].delta might be {"content": "..."}
-        delta = chunk.choices[0].delta
-        if content := delta.content:
-            yield content
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None and stats is not None:
+                stats.completion_tokens = chunk.usage.completion_tokens
+            if not chunk.choices:
+                continue
 
-        # if finish_reason is set, stop early
-        if chunk.choices[0].finish_reason is not None:
-            break
+            # chunk.choices[0].delta might be {"content": "..."}
+            delta = chunk.choices[0].delta
+            if content := delta.content:
+                yield content
+            # no break on finish_reason: only [DONE] (and usage) is left,
+            # and a response read to the end leaves its connection in the pool
+    finally:
+        # also runs when the caller closes the generator early, which drops
+        # the connection instead of draining the rest of the answer
+        await stream.close()
 
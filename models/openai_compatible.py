@@ -0,0 +1,30 @@
+import os
+
+from openai import AsyncOpenAI
+
+from models.openai import client_options, prewarmer, retry_delay, stream_chat
+from models.retry import MAX_RETRIES, with_retries
+
+
+def create(name, options):
+    """
+    Any server that speaks the OpenAI chat completions API: llama.cpp's
+    llama-server, vLLM, LM Studio, hosted gateways. Options:
+
+        base_url      defaults to http://localhost:8080/v1 (llama-server)
+        stream_usage  set to false for servers that reject stream_options
+        max_retries   retries after a failed request, defaults to 4
+    """
+    client = AsyncOpenAI(
+        base_url=options.get("base_url", "http://localhost:8080/v1"),
+        # local servers accept any key
+        api_key=os.environ.get(f"{name.upper()}_API_KEY", "none"),
+        **client_options(),
+    )
+    usage = options.get("stream_usage", True)
+
+    def complete(model, messages, stats=None):
+        return stream_chat(client, model, messages, stats, usage=usage)
+    complete = with_retries(complete, retry_delay, options.get("max_retries", MAX_RETRIES))
+    complete.prewarm = prewarmer(client)
+    return complete
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+# A prewarm within this many seconds of the last one is skipped; keep it
+# below keepalive_expiry (see models.http) so a warmed connection is still
+# there.
+PREWARM_INTERVAL = 15.0
+
+# Give up on a prewarm after this long, the request opens its own connection
+PREWARM_TIMEOUT = 10.0
+
+
+class Prewarmer:
+    """
+    Calls warm(), an async request that opens a pooled connection to the
+    provider, at most once per `interval` seconds and never twice at once.
+
+    Providers attach one to their complete() function as complete.prewarm,
+    so the DNS lookup and the TCP and TLS handshakes happen while the user
+    is still typing instead of after they press enter. Failures are
+    ignored: a prewarm is only a head start.
+    """
+
+    def __init__(self, warm, interval=PREWARM_INTERVAL):
+        self.warm = warm
+        self.interval = interval
+        self._last = None
+        self._running = False
+
+    async def __call__(self):
+        now = time.monotonic()
+        if self._running or (self._last is not None and now - self._last < self.interval):
+            return
+        self._running = True
+        try:
+            await asyncio.wait_for(self.warm(), PREWARM_TIMEOUT)
+            self._last = time.monotonic()
+        except Exception:
+            # the server may be down for now, try again next time
+            self._last = None
+        finally:
+            self._running = False
+
+
+async def prewarm(complete):
+    # open a connection for complete(), if its provider supports it
+    warm = getattr(complete, "prewarm", None)
+    if warm is None:
+        return
+    try:
+        await warm()
+    except Exception:
+        # plugins may not wrap theirs in a Prewarmer
+        pass
@@ -0,0 +1,105 @@
+import importlib
+
+# Third-party packages add backends under this entry point group; the
+# entry point names a factory like the built-in ones below.
+ENTRY_POINT_GROUP = "terminal_gpt.providers"
+
+# What a backend can do:
+#   api_key  needs {PROVIDER}_API_KEY to be set
+#   usage    reports token usage, otherwise tokens are estimated
+#   local    talks to a server on this machine
+#   remote   talks to a hosted service
+CAPABILITIES = {"api_key", "usage", "local", "remote"}
+
+
+class ProviderSpec:
+    """
+    A backend that can be selected by name in config.toml. The module is
+    only imported when a model of this provider is first used.
+
+    target is "module:factory". factory(name, options) returns a function
+    complete(model, messages, stats=None) that yields the text of the
+    answer as it streams in; options is the provider's config table.
+    complete.prewarm, if set, is an async function that opens a connection
+    ahead of the first request (see models.prewarm).
+    """
+
+    def __init__(self, name, target, capabilities=None, entry_point=None):
+        self.name = name
+        self.target = target
+        # None: declared by the factory, known once it is loaded
+        self._capabilities = frozenset(capabilities) if capabilities is not None else None
+        self._entry_point = entry_point
+        self._factory = None
+
+    def load(self):
+        if self._factory is None:
+            if self._entry_point is not None:
+                self._factory = self._entry_point.load()
+            else:
+                module, _, attr = self.target.partition(":")
+                self._factory = getattr(importlib.import_module(module), attr)
+        return self._factory
+
+    @property
+    def capabilities(self):
+        if self._capabilities is None:
+            self._capabilities = frozenset(getattr(self.load(), "capabilities", ()))
+        return self._capabilities
+
+    def declares(self, capability):
+        # without importing a plugin, undeclared means no
+        if self._capabilities is None and self._factory is None:
+            return False
+        return capability in self.capabilities
+
+
+BUILTINS = {
+    spec.name: spec for spec in (
+        ProviderSpec("openai", "models.openai:create", {"api_key", "usage", "remote"}),
+        ProviderSpec("openai-compatible", "models.openai_compatible:create", {"usage"}),
+        ProviderSpec("ollama", "models.ollama:create", {"usage", "local"}),
+        ProviderSpec("mock", "models.mock:create", {"usage", "local"}),
+    )
+}
+
+_plugins = None
+_completions = {}
+
+
+def plugins():
+    # entry points are only looked up when a name isn't built in
+    global _plugins
+    if _plugins is None:
+        # importlib.metadata alone costs more than the rest of startup
+        from importlib.metadata import entry_points
+
+        _plugins = {
+            ep.name: ProviderSpec(ep.name, ep.value, entry_point=ep)
+            for ep in entry_points(group=ENTRY_POINT_GROUP)
+        }
+    return _plugins
+
+
+def find_provider(kind):
+    spec = BUILTINS.get(kind)
+    if spec is None:
+        spec = plugins().get(kind)
+    return spec
+
+
+def provider_kind(model):
+    # a config section can pick its backend with type = "...", by default
+    # the section name is the backend
+    return model.get("type", model.get("provider"))
+
+
+def get_completion(model: dict):
+    """The complete() function for a model dict, one per configured provider."""
+    name = model.get("provider")
+    if name not in _completions:
+        spec = find_provider(provider_kind(model))
+        if spec is None:
+            raise ValueError(f"Unsupported provider: {provider_kind(model)}")
+        _completions[name] = spec.load()(name, model.get("options", {}))
+    return _completions[name]
@@ -0,0 +1,96 @@
+import asyncio
+import email.utils
+import random
+import time
+
+from models.main import continuation_messages
+
+# Retries after the first attempt, override with max_retries in a provider's
+# config table
+MAX_RETRIES = 4
+
+# Backoff before retry n is uniform in [0, min(BACKOFF_CAP, BACKOFF_BASE * 2**n)]
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+
+# Give up instead of waiting longer than this for a Retry-After
+MAX_RETRY_AFTER = 60.0
+
+# Request timeout, conflict, rate limit and server side errors
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def retry_after(headers):
+    # seconds the server asked us to wait, None if it didn't say
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(float(value) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+def status_delay(status, headers=None):
+    # what retry_delay returns for an HTTP error response
+    if status not in RETRY_STATUS:
+        return None
+    return retry_after(headers) or 0.0
+
+
+def backoff(attempt, wait=0.0):
+    # full jitter, so clients that failed together don't retry together
+    return wait + random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def with_retries(complete, retry_delay, max_retries=MAX_RETRIES):
+    """
+    Wrap a provider's complete() so failed requests are retried.
+
+    retry_delay(error) returns None if error can't be retried, otherwise
+    the least number of seconds to wait (a Retry-After, or 0); jittered
+    exponential backoff is added on top. If the connection drops after part
+    of the answer has streamed in, the retry asks the model to continue from
+    there instead of starting over, and only the new text is yielded.
+
+    Retries are reported to stats.retry(error, delay) if stats is given.
+    """
+
+    async def retrying(model, messages, stats=None):
+        partial = ""
+        attempt = 0
+        while True:
+            request = continuation_messages(messages, partial) if partial else messages
+            response = complete(model, request, stats)
+            try:
+                async for text in response:
+                    partial += text
+                    yield text
+                return
+            except Exception as error:
+                wait = retry_delay(error)
+                if wait is None or wait > MAX_RETRY_AFTER or attempt >= max_retries:
+                    raise
+                failure = error
+            finally:
+                await response.aclose()
+            delay = backoff(attempt, wait)
+            attempt += 1
+            if stats is not None:
+                stats.retry(failure, delay)
+            await asyncio.sleep(delay)
+
+    return retrying
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
+import argparse
 import json
 import shutil
 import sys
 
 from wcwidth import wcswidth
 
+from storage import load_messages
+from storage.blobs import BlobStore
+
 palette = [
     ('user', 'black', 'dark blue'),
     ('assistant', 'black', 'dark green'),
@@ -113,17 +117,19 @@ def get_width(lines, max_width):
     return min(longest_line_width, max_width)
 
 
-def render_chat_file(chat_file: str, cols: int) -> None:
-    """Render chat messages from a JSON file to the terminal."""
+def render_chat_file(chat_file: str, cols: int, last=None, blobs=None) -> None:
+    """Render chat messages from a JSON or JSON lines chat file to the terminal."""
     try:
-        with open(chat_file, 'r', encoding='utf-8') as f:
-            messages = json.load(f)
+        messages = load_messages(chat_file, last=last, blobs=blobs)
     except FileNotFoundError:
         print(f"Error: File not found: {chat_file}", file=sys.stderr)
         return
     except json.JSONDecodeError:
         print(f"Error: Failed to decode JSON from file: {chat_file}", file=sys.stderr)
         return
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return
 
     string = ''
 
@@ -149,17 +155,15 @@ def render_chat_file(chat_file: str, cols: int) -> None:
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: render_chat FILE.json", file=sys.stderr)
-        sys.exit(1)
-    size = shutil.get_terminal_size()
-# else get terminal size
-
-    chat_file = sys.argv[1]
-    # else get terminal size
-    cols = int(sys.argv[2]) if len(sys.argv) > 2 else size.columns
-
-    render_chat_file(chat_file, cols)
+    parser = argparse.ArgumentParser(prog="render_chat", description="Render a chat file to the terminal.")
+    parser.add_argument("chat_file", metavar="FILE", help="chat file (.json, .json.gz/.xz/.bz2, .jsonl or DB.db#ID)")
+    parser.add_argument("cols", metavar="COLUMNS", type=int, nargs="?", help="width, defaults to the terminal width")
+    parser.add_argument("--last", metavar="N", type=int, help="only render the last N messages")
+    parser.add_argument("--blobs", metavar="DIR", help="blob directory, if not the default one")
+    args = parser.parse_args()
+
+    cols = args.cols if args.cols is not None else shutil.get_terminal_size().columns
+    render_chat_file(args.chat_file, cols, last=args.last, blobs=BlobStore(args.blobs) if args.blobs else None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+# Milliseconds each module may take to import, site excluded. main is paid
+# by every invocation, --help and config errors included; app is what
+# opening a chat adds before the first frame. Override with
+# startup_budget = { main = ..., app = ... } in config.toml.
+BUDGETS = {"main": 30, "app": 300}
+
+# Modules main must leave to the code paths that need them.
+DEFERRED = ("app", "urwid", "openai", "httpx", "sqlite3", "importlib.metadata")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_tree(module):
+    """
+    Import module in a fresh interpreter under -X importtime. Returns
+    (name, self_us, cumulative_us) for module and everything it imported,
+    the module itself last.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env=env, cwd=ROOT)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr.strip()}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        if not own.strip().isdigit():
+            continue  # the header line
+        if not name.startswith("  "):
+            # a top-level import; children are listed before their parent,
+            # so whatever came before belongs to an earlier one (site)
+            if name.strip() == module:
+                rows.append((module, int(own), int(cumulative)))
+                return rows
+            rows = []
+            continue
+        rows.append((name.strip(), int(own), int(cumulative)))
+    raise RuntimeError(f"no import time reported for {module}")
+
+
+def measure(module, runs=5):
+    # the fastest run, the others are the disk cache and the scheduler
+    return min((import_tree(module) for _ in range(max(runs, 1))), key=lambda rows: rows[-1][2])
+
+
+def report(budgets=None, runs=5, top=10, out=sys.stdout):
+    """Print import times per entry point, False if one is over budget."""
+    budgets = {**BUDGETS, **(budgets or {})}
+    ok = True
+    for module, budget in budgets.items():
+        rows = measure(module, runs)
+        total = rows[-1][2] / 1000
+        verdict = "ok" if total <= budget else "OVER BUDGET"
+        ok = ok and total <= budget
+        print(f"{module}: {total:.1f} ms of {budget} ms budget, {len(rows)} modules  {verdict}", file=out)
+        for name, own, cumulative in sorted(rows, key=lambda row: row[1], reverse=True)[:top]:
+            print(f"    {own / 1000:7.1f} ms self {cumulative / 1000:7.1f} ms total  {name}", file=out)
+        if module == "main":
+            eager = sorted({name for name, _own, _cumulative in rows} & set(DEFERRED))
+            if eager:
+                ok = False
+                print(f"    imported at startup, should be deferred: {', '.join(eager)}", file=out)
+    return ok
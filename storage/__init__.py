@@ -0,0 +1,27 @@
+from storage.compression import compression_of, strip_compression
+from storage.index import as_dict
+from storage.journal import JournalStore
+from storage.json_store import JsonStore
+from storage.sqlite_store import SqliteStore, split_path
+
+
+def open_store(path, blobs=None, create=False):
+    # blobs: a BlobStore to save long message contents to
+    database = split_path(path)
+    if database is not None:
+        # "chats.db#12" is conversation 12; "chats.db" is a new one when
+        # writing (create), an error when reading
+        return SqliteStore(*database, create=create)
+    if path.endswith('.jsonl'):
+        return JournalStore(path, blobs)
+    if compression_of(path) and strip_compression(path).endswith('.jsonl'):
+        raise ValueError(f"{path}: compressed journals are not supported, use .json.gz, .json.xz or .json.bz2")
+    return JsonStore(path, blobs)
+
+
+def load_messages(path, last=None, blobs=None):
+    # decodes only the last `last` messages when the file has an index
+    messages = open_store(path, blobs).load()
+    if last is not None:
+        messages = messages[-last:] if last > 0 else []
+    return [as_dict(message) for message in messages]
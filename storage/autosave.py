@@ -0,0 +1,80 @@
+import asyncio
+import sqlite3
+
+# what a failed save raises: disk full, read-only directory, locked database
+SAVE_ERRORS = (OSError, sqlite3.Error)
+
+
+class Autosaver:
+    """
+    Saves the chat in the background after it changes.
+
+    request() is cheap and can be called on every change; run() is the
+    task that does the saving. A save runs once changes have stopped for
+    `delay` seconds, or at the latest `max_delay` seconds after the first of
+    them. The snapshot is taken on the event loop, encoding and writing
+    happen in a worker thread.
+
+    A save that fails is reported to on_error(error) and the store is
+    marked as needing a full save again, so the next change (or shutdown)
+    tries once more.
+    """
+
+    def __init__(self, store, snapshot, delay=1.0, max_delay=5.0, on_error=None):
+        self.store = store
+        self.snapshot = snapshot
+        self.on_error = on_error
+        self.delay = delay
+        self.max_delay = max_delay
+        self._changed = asyncio.Event()
+        self._saving = None
+
+    def request(self):
+        self._changed.set()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._changed.wait()
+            deadline = loop.time() + self.max_delay
+            # coalesce a burst of changes into one save
+            while True:
+                self._changed.clear()
+                timeout = min(self.delay, deadline - loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            await self.save()
+
+    async def save(self):
+        if self._saving is not None:
+            await self._saving
+        if not self.store.needs_save():
+            return
+        self.store.begin_save()
+        messages = self.snapshot()
+        saving = self._saving = asyncio.ensure_future(self._write(messages))
+        try:
+            # the thread can't be stopped, so cancelling only stops the wait
+            await asyncio.shield(saving)
+        finally:
+            if saving.done():
+                self._saving = None
+
+    async def _write(self, messages):
+        try:
+            await asyncio.to_thread(self.store.save, messages)
+        except SAVE_ERRORS as error:
+            # begin_save() cleared the flag, what was saved is not on disk
+            self.store.invalidate()
+            if self.on_error is not None:
+                self.on_error(error)
+
+    async def wait(self):
+        # let a save that is already writing finish
+        if self._saving is not None:
+            await self._saving
+            self._saving = None
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import lzma
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+from storage.compression import compression_of, strip_compression
+from storage.files import atomic_write
+
+DEFAULT_ROOT = "~/.local/share/terminal_gpt/blobs"
+# a content_ref as json.dumps writes it, to find references without decoding
+REF = re.compile(rb'"content_ref": "([0-9a-f]{64})"')
+
+
+class BlobStore:
+    """
+    Content-addressed message texts shared by all chat files.
+
+    A message whose content is at least min_size characters is written as
+    {"content_ref": <sha256>} and its text goes to objects/ab/cdef... once,
+    zlib-compressed, however many chats contain it. Every chat file saved
+    with blobs lists the digests it references in refs/; gc() removes the
+    objects no existing chat refers to, nor any other chat file in the
+    folders of the chats it knows of, such as a copy that was never opened.
+    """
+
+    # objects younger than this are never collected, a chat may be about to
+    # record its references
+    GC_GRACE = 3600
+
+    def __init__(self, root=DEFAULT_ROOT, min_size=1024, cache_size=64):
+        self.root = os.path.expanduser(root)
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # get() runs on the UI thread and on load and autosave workers
+        self._cache_lock = threading.Lock()
+
+    def __eq__(self, other):
+        return isinstance(other, BlobStore) and other.root == self.root
+
+    def __hash__(self):
+        return hash(self.root)
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:])
+
+    def _refs_path(self, chat_path):
+        name = hashlib.sha256(os.path.abspath(chat_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'refs', name + '.json')
+
+    def put(self, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_write(path, mode='wb') as f:
+                f.write(zlib.compress(data, 6))
+        return digest
+
+    def get(self, digest):
+        with self._cache_lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return self._cache[digest]
+        with open(self._object_path(digest), 'rb') as f:
+            text = zlib.decompress(f.read()).decode('utf-8')
+        with self._cache_lock:
+            self._cache[digest] = text
+            self._cache.move_to_end(digest)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return text
+
+    def externalize(self, message):
+        content = message.get('content', '')
+        if len(content) < self.min_size:
+            return message
+        message = {k: v for k, v in message.items() if k != 'content'}
+        message['content_ref'] = self.put(content)
+        return message
+
+    def resolve(self, message):
+        message = dict(message)
+        message['content'] = self.get(message.pop('content_ref'))
+        return message
+
+    def has_refs(self, chat_path):
+        return os.path.exists(self._refs_path(chat_path))
+
+    def set_refs(self, chat_path, digests):
+        # kept when empty too, gc looks for copies next to every known chat
+        path = self._refs_path(chat_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump({"chat": os.path.abspath(chat_path), "blobs": sorted(digests)}, f)
+
+    def refcounts(self):
+        # how many existing chats reference each object; refs of chats
+        # that were deleted are dropped
+        counts = Counter()
+        refs_dir = os.path.join(self.root, 'refs')
+        if not os.path.isdir(refs_dir):
+            return counts
+        tracked = set()
+        for name in os.listdir(refs_dir):
+            path = os.path.join(refs_dir, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    refs = json.load(f)
+            except (OSError, ValueError):
+                continue
+            tracked.add(refs["chat"])
+            if not os.path.exists(refs["chat"]):
+                os.unlink(path)
+                continue
+            counts.update(refs["blobs"])
+        # chat files copied with cp only register once they are opened
+        for folder in {os.path.dirname(chat) for chat in tracked}:
+            for chat in untracked_chats(folder, tracked):
+                counts.update(chat_refs(chat))
+        return counts
+
+    def gc(self):
+        """Delete unreferenced objects. Returns (objects removed, bytes freed)."""
+        counts = self.refcounts()
+        removed = freed = 0
+        objects_dir = os.path.join(self.root, 'objects')
+        if not os.path.isdir(objects_dir):
+            return removed, freed
+        cutoff = time.time() - self.GC_GRACE
+        for prefix in os.listdir(objects_dir):
+            for rest in os.listdir(os.path.join(objects_dir, prefix)):
+                if counts[prefix + rest]:
+                    continue
+                path = os.path.join(objects_dir, prefix, rest)
+                st = os.stat(path)
+                if st.st_mtime > cutoff:
+                    continue
+                os.unlink(path)
+                removed += 1
+                freed += st.st_size
+        return removed, freed
+
+
+_default = None
+
+
+def resolve(message, blobs=None):
+    # message with its content_ref, if any, replaced by the text
+    global _default
+    if 'content_ref' not in message:
+        return message
+    if blobs is None:
+        if _default is None:
+            _default = BlobStore()
+        blobs = _default
+    return blobs.resolve(message)
+
+
+def untracked_chats(folder, tracked):
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return []
+    paths = (os.path.join(folder, name) for name in names
+             if strip_compression(name).endswith(('.json', '.jsonl')))
+    return [path for path in paths if path not in tracked and os.path.isfile(path)]
+
+
+def chat_refs(path):
+    # digests referenced in a chat file, without decoding it
+    opener = compression_of(path)
+    try:
+        with open(path, 'rb') as raw, (opener(raw, 'rb') if opener else raw) as f:
+            return refs_in(f.read())
+    except (OSError, EOFError, lzma.LZMAError):
+        return set()
+
+
+def refs_in(data):
+    # digests referenced in encoded messages
+    return {digest.decode('ascii') for digest in REF.findall(data)}
+
+
+def refs_of(messages):
+    return {message['content_ref'] for message in messages if 'content_ref' in message}
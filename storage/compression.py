@@ -0,0 +1,26 @@
+import bz2
+import gzip
+import lzma
+
+# Compressed chat files are recognised by their last extension. Each opener
+# takes a path or a binary file object and streams through the codec.
+OPENERS = {
+    '.gz': lambda f, mode: gzip.open(f, mode, compresslevel=6),
+    '.xz': lambda f, mode: lzma.open(f, mode, preset=2 if 'w' in mode else None),
+    '.bz2': lambda f, mode: bz2.open(f, mode, compresslevel=9),
+}
+
+
+def compression_of(path):
+    # the opener for a compressed path, None for a plain one
+    for suffix, opener in OPENERS.items():
+        if path.endswith(suffix):
+            return opener
+    return None
+
+
+def strip_compression(path):
+    for suffix in OPENERS:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
@@ -0,0 +1,46 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='w', encoding='utf-8', on_replace=None):
+    """
+    Write a file so that readers (and a crash) only ever see the old or the
+    complete new content: write a temp file next to it, fsync, then rename.
+    on_replace() is called as soon as the new file is in place, before the
+    rename is made durable.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        with os.fdopen(fd, mode, encoding=None if 'b' in mode else encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if on_replace is not None:
+            on_replace()
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    fsync_directory(directory)
+
+
+def fsync_directory(directory):
+    # makes the rename itself durable
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
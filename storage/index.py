@@ -0,0 +1,137 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+from storage.blobs import refs_in, resolve
+from storage.files import atomic_write
+
+# Sidecar index next to a chat file: where each message starts and ends, so
+# the file can be memory-mapped and messages decoded only when needed.
+#
+# Layout: header (magic, device and inode of the chat file, number of bytes
+# the index covers, message count, check) followed by a start and end offset
+# per message. The index belongs to one version of the chat file: saves
+# replace the file, which gives it a new inode. A file rewritten in place
+# keeps its inode, the check catches that: a CRC of the bytes before the
+# first message and of the last message.
+MAGIC = b'TGPTIDX2'
+HEADER = struct.Struct('<8sQQQQI')
+
+
+class RawMessage:
+    # A message still encoded in a memory-mapped chat file, blobs is the
+    # BlobStore its content_ref points into (None for the default one)
+    __slots__ = ('source', 'start', 'end', 'blobs')
+
+    def __init__(self, source, start, end, blobs=None):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.blobs = blobs
+
+    def raw(self):
+        return self.source[self.start:self.end]
+
+    def decode(self):
+        return resolve(json.loads(self.raw()), self.blobs)
+
+
+def as_dict(message):
+    if isinstance(message, RawMessage):
+        return message.decode()
+    return message
+
+
+def prepare_messages(messages, blobs):
+    """
+    Return the messages as a store writing to blobs (None: contents inline)
+    should encode them, and the set of digests they reference.
+    """
+    prepared = []
+    refs = set()
+    for message in messages:
+        if isinstance(message, RawMessage):
+            if message.blobs == blobs:
+                # already encoded the way it will be written
+                if blobs is not None:
+                    refs |= refs_in(message.raw())
+                prepared.append(message)
+                continue
+            message = message.decode()
+        if blobs is not None:
+            message = blobs.externalize(message)
+            if 'content_ref' in message:
+                refs.add(message['content_ref'])
+        prepared.append(message)
+    return prepared, refs
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def check(fd, offsets, covered):
+    # reads a few small pieces of the file, not the whole of it
+    if not offsets:
+        return zlib.crc32(os.pread(fd, covered, 0))
+    crc = zlib.crc32(os.pread(fd, offsets[0], 0))
+    return zlib.crc32(os.pread(fd, covered - offsets[-2], offsets[-2]), crc)
+
+
+def write_index(path, offsets, covered):
+    # call after the chat file has been renamed into place
+    with open(path, 'rb') as chat:
+        st = os.fstat(chat.fileno())
+        crc = check(chat.fileno(), offsets, covered)
+    with atomic_write(index_path(path), mode='wb') as f:
+        f.write(HEADER.pack(MAGIC, st.st_dev, st.st_ino, covered, len(offsets) // 2, crc))
+        f.write(array('Q', offsets).tobytes())
+
+
+def remove_index(path):
+    try:
+        os.unlink(index_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def read_index(path, exact=True):
+    # exact: the index must cover the whole file, otherwise more may follow
+    try:
+        with open(index_path(path), 'rb') as f:
+            data = f.read()
+        chat = open(path, 'rb')
+    except OSError:
+        return None
+    with chat:
+        st = os.fstat(chat.fileno())
+        if len(data) < HEADER.size:
+            return None
+        magic, dev, ino, covered, count, crc = HEADER.unpack_from(data)
+        if magic != MAGIC or (dev, ino) != (st.st_dev, st.st_ino):
+            return None
+        if covered > st.st_size or (exact and covered != st.st_size):
+            return None
+        offsets = array('Q')
+        offsets.frombytes(data[HEADER.size:])
+        if len(offsets) != 2 * count or check(chat.fileno(), offsets, covered) != crc:
+            return None
+    return covered, offsets
+
+
+def map_messages(path, exact=True, blobs=None):
+    """
+    Return (messages, covered) with a RawMessage per indexed message, or None
+    if there is no index that matches the file.
+    """
+    index = read_index(path, exact)
+    if index is None:
+        return None
+    covered, offsets = index
+    with open(path, 'rb') as f:
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    messages = [RawMessage(source, offsets[i], offsets[i + 1], blobs) for i in range(0, len(offsets), 2)]
+    return messages, covered
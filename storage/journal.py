@@ -0,0 +1,236 @@
+import json
+import os
+import threading
+
+from storage.blobs import refs_in, resolve
+from storage.files import atomic_write
+from storage.index import RawMessage, map_messages, prepare_messages, read_index, write_index
+from storage.json_store import BATCH_SIZE
+from storage.ops import apply_op
+
+
+class JournalStore:
+    """
+    Chat file kept as an append-only JSON lines journal.
+
+    The file starts with a snapshot header {"op": "snapshot", "count": N}
+    followed by N message lines, then one line per operation made since.
+    Loading replays the operations on top of the snapshot. Compaction writes
+    a fresh snapshot and atomically replaces the file.
+
+    Compaction may run on a worker thread while operations keep being
+    recorded: begin_save() marks the point the snapshot is taken at, and
+    operations recorded after it are carried over into the new file.
+
+    With blobs, long contents in the snapshot are saved to the BlobStore and
+    referenced; operations are always written with the full text.
+    """
+
+    COMPACT_EVERY = 500
+
+    def __init__(self, path, blobs=None):
+        self.path = path
+        self.blobs = blobs
+        self._file = None
+        self._lock = threading.Lock()
+        self._carry_over = None
+        self._stale = False
+        self.ops_since_snapshot = 0
+
+    def load(self):
+        mapped = map_messages(self.path, exact=False, blobs=self.blobs)
+        if mapped is not None:
+            # the snapshot stays encoded, only the operations after it are read
+            messages, covered = mapped
+            # replaying ops replaces entries of messages, take it before
+            source = messages[0].source if messages else None
+            try:
+                # a wrong index shows at the ends of what it covers
+                for message in messages[:1] + messages[-1:]:
+                    message.decode()
+                with open(self.path, 'rb') as f:
+                    f.seek(covered)
+                    messages, self.ops_since_snapshot = read_journal(f, messages, self.blobs)
+            except (ValueError, IndexError):
+                # the index doesn't fit the file after all, read all of it
+                pass
+            else:
+                if source is not None and self._untracked():
+                    self._track_refs(refs_in(source))
+                return messages
+        refs = set()
+        with open(self.path, 'rb') as f:
+            messages, self.ops_since_snapshot = read_journal(f, blobs=self.blobs, refs=refs)
+        self._track_refs(refs)
+        return messages
+
+    def _track_refs(self, refs):
+        # see JsonStore._track_refs
+        if self.blobs is not None:
+            self.blobs.set_refs(self.path, refs)
+
+    def _untracked(self):
+        # see JsonStore._untracked
+        return self.blobs is not None and not self.blobs.has_refs(self.path)
+
+    def indexed(self):
+        return read_index(self.path, exact=False) is not None
+
+    def needs_index(self):
+        return not self.indexed()
+
+    def load_batches(self, batch_size=BATCH_SIZE):
+        """
+        Like JsonStore.load_batches. Snapshot messages are yielded as they
+        are read; once operations follow, the replayed result is yielded as
+        a whole at the end.
+        """
+        size = os.path.getsize(self.path) or 1
+        messages = []
+        shown = 0
+        ops = 0
+        remaining = 0
+        streaming = True
+        read = 0
+        refs = set()
+        with open(self.path, 'rb') as f:
+            for line in f:
+                read += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if remaining:
+                    if 'content_ref' in entry:
+                        refs.add(entry['content_ref'])
+                    messages.append(resolve(entry, self.blobs))
+                    remaining -= 1
+                    if streaming and len(messages) - shown >= batch_size:
+                        yield shown, messages[shown:], read / size
+                        shown = len(messages)
+                elif entry.get("op") == "snapshot":
+                    messages = []
+                    ops = 0
+                    remaining = entry["count"]
+                    streaming = streaming and shown == 0
+                else:
+                    apply_op(messages, entry)
+                    ops += 1
+                    streaming = False
+        self.ops_since_snapshot = ops
+        self._track_refs(refs)
+        if streaming:
+            yield shown, messages[shown:], 1.0
+        else:
+            yield 0, messages, 1.0
+
+    def record(self, op):
+        line = (json.dumps(op, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(line)
+            self._file.flush()
+            self.ops_since_snapshot += 1
+            if self._carry_over is not None:
+                self._carry_over.append(line)
+
+    def should_compact(self):
+        return self.ops_since_snapshot >= self.COMPACT_EVERY
+
+    def needs_save(self):
+        # every change is already on disk, unless invalidate() was called
+        return self._stale or self.should_compact()
+
+    def invalidate(self):
+        # changes were not journaled, the next save writes a full snapshot
+        self._stale = True
+
+    def begin_save(self):
+        with self._lock:
+            self._stale = False
+            self._carry_over = []
+
+    def save(self, messages):
+        messages, refs = prepare_messages(messages, self.blobs)
+        locked = False
+
+        def unlock():
+            nonlocal locked
+            self._carry_over = None
+            if locked:
+                locked = False
+                self._lock.release()
+        try:
+            with atomic_write(self.path, mode='wb', on_replace=unlock) as f:
+                offsets, covered = write_snapshot(f, messages)
+                # the snapshot goes to disk while record() can still append,
+                # only the tail and the rename are done under the lock
+                f.flush()
+                os.fsync(f.fileno())
+                self._lock.acquire()
+                locked = True
+                carry_over = self._carry_over or []
+                f.writelines(carry_over)
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self.ops_since_snapshot = len(carry_over)
+        finally:
+            unlock()
+        write_index(self.path, offsets, covered)
+        if self.blobs is not None:
+            self.blobs.set_refs(self.path, refs)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def encode_line(message):
+    if isinstance(message, RawMessage):
+        data = message.raw()
+        if b'\n' not in data:
+            return data
+        message = message.decode()
+    return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+
+def write_snapshot(f, messages):
+    # returns the start and end offset of every message and where the
+    # snapshot ends
+    offsets = []
+    pos = f.write((json.dumps({"op": "snapshot", "count": len(messages)}) + '\n').encode('utf-8'))
+    for message in messages:
+        data = encode_line(message)
+        offsets += (pos, pos + len(data))
+        pos += f.write(data + b'\n')
+    return offsets, pos
+
+
+def read_journal(f, messages=None, blobs=None, refs=None):
+    # refs, if given, collects the digests the snapshot references
+    messages = messages if messages is not None else []
+    ops = 0
+    remaining = 0
+    for line in f:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # a line cut short by a crash, everything before it is intact
+            break
+        if remaining:
+            if refs is not None and 'content_ref' in entry:
+                refs.add(entry['content_ref'])
+            messages.append(resolve(entry, blobs))
+            remaining -= 1
+        elif entry.get("op") == "snapshot":
+            messages = []
+            ops = 0
+            remaining = entry["count"]
+        else:
+            apply_op(messages, entry)
+            ops += 1
+    return messages, ops
@@ -0,0 +1,187 @@
+import codecs
+import json
+import os
+import re
+
+from storage.blobs import refs_in, refs_of, resolve
+from storage.compression import compression_of
+from storage.files import atomic_write
+from storage.index import RawMessage, map_messages, prepare_messages, read_index, remove_index, write_index
+
+BATCH_SIZE = 500
+CHUNK_SIZE = 1 << 20
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStore:
+    # A JSON array of messages, rewritten as a whole on save. Paths ending
+    # in .gz, .xz or .bz2 are compressed; those have no offset index. With
+    # blobs, long contents are saved to the BlobStore and referenced.
+    def __init__(self, path, blobs=None):
+        self.path = path
+        self.blobs = blobs
+        self.compression = compression_of(path)
+        self._dirty = False
+
+    def _open(self, f):
+        # f is the file opened in binary mode
+        return self.compression(f, f.mode) if self.compression else f
+
+    def load(self):
+        if self.compression is None:
+            mapped = map_messages(self.path, blobs=self.blobs)
+            if mapped is not None:
+                messages = mapped[0]
+                if messages and self._untracked():
+                    self._track_refs(refs_in(messages[0].source))
+                return messages
+        with open(self.path, 'rb') as raw, self._open(raw) as f:
+            messages = json.load(f)
+        self._track_refs(refs_of(messages))
+        return [resolve(message, self.blobs) for message in messages]
+
+    def _track_refs(self, refs):
+        # a copied chat file shares blobs with the original, they have to
+        # outlive it
+        if self.blobs is not None:
+            self.blobs.set_refs(self.path, refs)
+
+    def _untracked(self):
+        # save() records the refs with the index, only a file indexed while
+        # blobs were off has to be searched for them
+        return self.blobs is not None and not self.blobs.has_refs(self.path)
+
+    def indexed(self):
+        return self.compression is None and read_index(self.path) is not None
+
+    def needs_index(self):
+        # a save would write an index the file doesn't have yet
+        return self.compression is None and read_index(self.path) is None
+
+    def load_batches(self, batch_size=BATCH_SIZE):
+        """
+        Parse the file a batch of messages at a time. Yields (start, messages,
+        fraction): the messages go at index start, replacing whatever was
+        yielded from there on before, and fraction of the file has been read.
+        """
+        size = os.path.getsize(self.path) or 1
+        start = 0
+        refs = set()
+        with open(self.path, 'rb') as raw, self._open(raw) as f:
+            for batch in iter_array(f, batch_size):
+                refs |= refs_of(batch)
+                batch = [resolve(message, self.blobs) for message in batch]
+                yield start, batch, raw.tell() / size
+                start += len(batch)
+        self._track_refs(refs)
+
+    def record(self, op):
+        # nothing is written until the next save
+        self._dirty = True
+
+    def should_compact(self):
+        return False
+
+    def needs_save(self):
+        return self._dirty
+
+    def invalidate(self):
+        # the file no longer matches the chat, the next save rewrites it
+        self._dirty = True
+
+    def begin_save(self):
+        # changes from here on need another save
+        self._dirty = False
+
+    def save(self, messages):
+        # may run on a worker thread
+        messages, refs = prepare_messages(messages, self.blobs)
+        if self.compression is not None:
+            # messages are encoded and compressed one at a time
+            with atomic_write(self.path, mode='wb') as raw, self.compression(raw, 'wb') as f:
+                write_messages(f, messages)
+            remove_index(self.path)
+        else:
+            with atomic_write(self.path, mode='wb') as f:
+                offsets, size = write_messages(f, messages)
+            write_index(self.path, offsets, size)
+        if self.blobs is not None:
+            self.blobs.set_refs(self.path, refs)
+
+    def close(self):
+        pass
+
+
+def iter_array(f, batch_size=BATCH_SIZE):
+    # Incrementally parse a JSON array of objects from a binary file,
+    # yielding lists of at most batch_size items.
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+
+    def fill():
+        nonlocal buf, pos
+        chunk = f.read(CHUNK_SIZE)
+        buf = buf[pos:] + text.decode(chunk, final=not chunk)
+        pos = 0
+        return bool(chunk)
+
+    started = False
+    expect_item = True
+    batch = []
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if not fill():
+                raise json.JSONDecodeError("Unterminated array" if started else "Expecting value", buf, pos)
+            continue
+        char = buf[pos]
+        if not started:
+            if char != '[':
+                raise json.JSONDecodeError("Expecting '['", buf, pos)
+            started = True
+            pos += 1
+        elif char == ']':
+            break
+        elif not expect_item:
+            if char != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+            expect_item = True
+            pos += 1
+        else:
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # most likely cut off at the end of the buffer
+                if fill():
+                    continue
+                raise
+            expect_item = False
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def encode_message(message):
+    if isinstance(message, RawMessage):
+        return message.raw()
+    # same layout as json.dump(messages, indent=2)
+    text = json.dumps(message, ensure_ascii=False, indent=2)
+    return text.replace('\n', '\n  ').encode('utf-8')
+
+
+def write_messages(f, messages):
+    # returns the start and end offset of every message and the total size
+    offsets = []
+    pos = f.write(b'[')
+    for i, message in enumerate(messages):
+        pos += f.write(b',\n  ' if i else b'\n  ')
+        data = encode_message(message)
+        offsets += (pos, pos + len(data))
+        pos += f.write(data)
+    pos += f.write(b'\n]' if messages else b']')
+    return offsets, pos
@@ -0,0 +1,86 @@
+# Operations on a message list, shared by the UI and the chat file journal.
+# An op is a small dict such as {"op": "insert", "index": 3, "message": {...}}.
+
+from storage.index import as_dict
+
+
+def updated_record(record, fields):
+    record = {**record, **fields}
+    for key, value in fields.items():
+        if value is None or value is False:
+            # keep optional flags out of the saved file
+            del record[key]
+    return record
+
+
+# Branches: the record where a conversation forks carries the other
+# continuations from that point on as "alts", a list of message lists, and
+# "branch", the position of the current one among all of them. The shared
+# prefix is stored once, branches can fork again further down.
+
+def _without_branches(record):
+    return {key: value for key, value in record.items() if key not in ("alts", "branch")}
+
+
+def branches(record):
+    # (current, total) for a branch point, None otherwise
+    alts = record.get("alts")
+    if not alts:
+        return None
+    return record.get("branch", len(alts)), len(alts) + 1
+
+
+def _suffixes(messages, index):
+    # every continuation at index, and the position of the current one
+    suffix = [as_dict(message) for message in messages[index:]]
+    if not suffix:
+        return [], 0
+    head = suffix[0]
+    alts = head.get("alts", [])
+    current = head.get("branch", len(alts))
+    suffix[0] = _without_branches(head)
+    return alts[:current] + [suffix] + alts[current:], current
+
+
+def fork(messages, index, message):
+    # keep messages[index:] as a branch and continue with message instead
+    suffixes, _current = _suffixes(messages, index)
+    if suffixes:
+        message = {**message, "alts": suffixes, "branch": len(suffixes)}
+    messages[index:] = [message]
+
+
+def cycle(messages, index, branch):
+    # make another branch at index the current one
+    suffixes, _current = _suffixes(messages, index)
+    chosen = suffixes.pop(branch)
+    messages[index:] = [{**chosen[0], "alts": suffixes, "branch": branch}] + chosen[1:]
+
+
+def apply_op(messages, op):
+    kind = op["op"]
+    if kind == "insert":
+        messages.insert(op["index"], op["message"])
+    elif kind == "delete":
+        del messages[op["index"]]
+    elif kind == "swap":
+        i, j = op["index"], op["other"]
+        messages[i], messages[j] = messages[j], messages[i]
+    elif kind == "append":
+        # text streamed into a message since the last checkpoint
+        fields = {key: value for key, value in op.items() if key not in ("op", "index", "text")}
+        message = as_dict(messages[op["index"]])
+        message = {**message, "content": message.get("content", "") + op["text"]}
+        messages[op["index"]] = updated_record(message, fields)
+    elif kind == "update":
+        fields = {key: value for key, value in op.items() if key not in ("op", "index")}
+        messages[op["index"]] = updated_record(as_dict(messages[op["index"]]), fields)
+    elif kind == "fork":
+        fork(messages, op["index"], op["message"])
+    elif kind == "cycle":
+        cycle(messages, op["index"], op["branch"])
+    elif kind == "splice":
+        # used to undo a fork or cycle
+        messages[op["index"]:] = op["messages"]
+    else:
+        raise ValueError(f"Unknown operation: {kind}")
@@ -0,0 +1,301 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from storage.index import as_dict
+from storage.json_store import BATCH_SIZE
+from storage.ops import apply_op, updated_record
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL DEFAULT '',
+    source TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation INTEGER NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    flags TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_position ON messages(conversation, position);
+"""
+
+# External content table: the index stores only tokens, triggers keep it in
+# step with the messages table.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+SEPARATOR = '#'
+
+
+def split_path(path):
+    # "chats.db#12" -> ("chats.db", 12), None if it doesn't name a database
+    base, sep, conversation = path.rpartition(SEPARATOR)
+    if sep and base.endswith(('.db', '.sqlite')) and conversation.isdigit():
+        return base, int(conversation)
+    if path.endswith(('.db', '.sqlite')):
+        return path, None
+    return None
+
+
+def connect(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # used from the event loop and the autosave worker, guarded by a lock
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA foreign_keys=ON")
+    db.executescript(SCHEMA)
+    try:
+        db.executescript(FTS_SCHEMA)
+    except sqlite3.OperationalError:
+        # sqlite built without FTS5, search falls back to LIKE
+        pass
+    return db
+
+
+def has_fts(db):
+    row = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+    return row is not None
+
+
+def create_conversation(db, source=None):
+    now = time.time()
+    cursor = db.execute("INSERT INTO conversations (source, created, updated) VALUES (?, ?, ?)", (source, now, now))
+    return cursor.lastrowid
+
+
+def new_chat(path):
+    # path of a new, empty conversation in the database at path
+    db = connect(path)
+    try:
+        return f"{path}{SEPARATOR}{create_conversation(db)}"
+    finally:
+        db.close()
+
+
+def title_of(messages):
+    for message in messages:
+        if message.get('role') == 'user' and message.get('content', '').strip():
+            return message['content'].strip().splitlines()[0][:80]
+    return ''
+
+
+def to_row(message):
+    flags = {k: v for k, v in message.items() if k not in ('content', 'role')}
+    return message.get('role', 'user'), message.get('content', ''), json.dumps(flags) if flags else None
+
+
+def from_row(role, content, flags):
+    message = {'content': content, 'role': role}
+    if flags:
+        message.update(json.loads(flags))
+    return message
+
+
+class SqliteStore:
+    """
+    One conversation in a SQLite database shared by all chats.
+
+    Every op is applied to the messages table in its own transaction, so
+    like the journal nothing is left to save afterwards. The database runs
+    in WAL mode: a commit is an append to the log, and searches from another
+    process don't block the chat that is being written.
+    """
+
+    def __init__(self, path, conversation=None, source=None, create=False):
+        # without a conversation, create makes a new one; reading a whole
+        # database as one chat is an error
+        if conversation is None and not create:
+            raise ValueError(f"{path} holds many chats, name one as {path}{SEPARATOR}ID")
+        if not create and not os.path.exists(path):
+            raise FileNotFoundError(f"no chat database at {path}")
+        self.path = path
+        self._db = connect(path)
+        self._lock = threading.Lock()
+        self._stale = False
+        if conversation is None:
+            conversation = create_conversation(self._db, source)
+        elif not create and not self._db.execute("SELECT 1 FROM conversations WHERE id = ?",
+                                                  (conversation,)).fetchone():
+            self._db.close()
+            raise FileNotFoundError(f"no conversation {conversation} in {path}")
+        self.conversation = conversation
+
+    def _rows(self, query="", args=()):
+        return self._db.execute(
+            "SELECT role, content, flags FROM messages WHERE conversation = ? " + query + " ORDER BY position",
+            (self.conversation, *args),
+        )
+
+    def load(self):
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM conversations WHERE id = ?", (self.conversation,)).fetchone() is None:
+                raise FileNotFoundError(f"no conversation {self.conversation} in {self.path}")
+            return [from_row(*row) for row in self._rows()]
+
+    def indexed(self):
+        # loading is a single indexed query
+        return True
+
+    def needs_index(self):
+        return False
+
+    def load_batches(self, batch_size=BATCH_SIZE):
+        yield 0, self.load(), 1.0
+
+    def record(self, op):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._apply(op)
+                self._touch()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _apply(self, op):
+        db, conversation = self._db, self.conversation
+        kind = op["op"]
+        if kind == "insert":
+            db.execute("UPDATE messages SET position = position + 1 WHERE conversation = ? AND position >= ?",
+                       (conversation, op["index"]))
+            db.execute("INSERT INTO messages (conversation, position, role, content, flags) VALUES (?, ?, ?, ?, ?)",
+                       (conversation, op["index"], *to_row(op["message"])))
+        elif kind == "delete":
+            db.execute("DELETE FROM messages WHERE conversation = ? AND position = ?", (conversation, op["index"]))
+            db.execute("UPDATE messages SET position = position - 1 WHERE conversation = ? AND position > ?",
+                       (conversation, op["index"]))
+        elif kind == "swap":
+            i, j = op["index"], op["other"]
+            db.execute("UPDATE messages SET position = CASE position WHEN ? THEN ? ELSE ? END "
+                       "WHERE conversation = ? AND position IN (?, ?)", (i, j, i, conversation, i, j))
+        elif kind in ("update", "append"):
+            row = self._rows("AND position = ?", (op["index"],)).fetchone()
+            if row is None:
+                return
+            message = from_row(*row)
+            fields = {k: v for k, v in op.items() if k not in ("op", "index", "text")}
+            if kind == "append":
+                fields["content"] = message.get("content", "") + op["text"]
+            role, content, flags = to_row(updated_record(message, fields))
+            db.execute("UPDATE messages SET role = ?, content = ?, flags = ? WHERE conversation = ? AND position = ?",
+                       (role, content, flags, conversation, op["index"]))
+        elif kind in ("fork", "cycle", "splice"):
+            # these replace the rest of the conversation
+            messages = [from_row(*row) for row in self._rows()]
+            apply_op(messages, op)
+            self._replace_all(messages)
+        else:
+            raise ValueError(f"unknown op {kind!r}")
+
+    def _replace_all(self, messages):
+        self._db.execute("DELETE FROM messages WHERE conversation = ?", (self.conversation,))
+        self._db.executemany(
+            "INSERT INTO messages (conversation, position, role, content, flags) VALUES (?, ?, ?, ?, ?)",
+            [(self.conversation, i, *to_row(message)) for i, message in enumerate(messages)],
+        )
+
+    def _touch(self, title=None):
+        if title is None:
+            self._db.execute("UPDATE conversations SET updated = ? WHERE id = ?", (time.time(), self.conversation))
+        else:
+            self._db.execute("UPDATE conversations SET updated = ?, title = ? WHERE id = ?",
+                             (time.time(), title, self.conversation))
+
+    def should_compact(self):
+        return False
+
+    def needs_save(self):
+        return self._stale
+
+    def invalidate(self):
+        self._stale = True
+
+    def begin_save(self):
+        self._stale = False
+
+    def save(self, messages):
+        # replace the whole conversation in one transaction
+        messages = [as_dict(message) for message in messages]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._replace_all(messages)
+                self._touch(title_of(messages))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            # name the conversation after its first question
+            row = self._db.execute("SELECT content FROM messages WHERE conversation = ? AND role = 'user' "
+                                   "AND trim(content) != '' ORDER BY position LIMIT 1", (self.conversation,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE conversations SET title = ? WHERE id = ?",
+                                 (title_of([{'role': 'user', 'content': row[0]}]), self.conversation))
+            self._db.close()
+
+
+def fts_query(query):
+    # every word must match, as a literal term rather than FTS5 syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def search(path, query, limit=20, highlight=('[', ']')):
+    """
+    Return (conversation, position, role, snippet, title) for the messages
+    matching query across all conversations, best match first. Matches in
+    the snippet are wrapped in the two highlight strings.
+    """
+    db = connect(path)
+    try:
+        if has_fts(db):
+            return db.execute(
+                "SELECT m.conversation, m.position, m.role, "
+                "snippet(messages_fts, 0, ?, ?, '...', 16), c.title "
+                "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                "JOIN conversations c ON c.id = m.conversation "
+                "WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts) LIMIT ?",
+                (*highlight, fts_query(query), limit),
+            ).fetchall()
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return db.execute(
+            "SELECT m.conversation, m.position, m.role, substr(m.content, 1, 120), c.title "
+            "FROM messages m JOIN conversations c ON c.id = m.conversation "
+            "WHERE m.content LIKE ? ESCAPE '\\' ORDER BY c.updated DESC LIMIT ?",
+            (pattern, limit),
+        ).fetchall()
+    finally:
+        db.close()
+
+
+def import_chat(path, messages, source=None):
+    # copy messages into a new conversation, returns its id
+    store = SqliteStore(path, source=source, create=True)
+    try:
+        store.save(messages)
+    finally:
+        store.close()
+    return store.conversation
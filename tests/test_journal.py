@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage.index import read_index
+from storage.journal import JournalStore
+from storage.ops import as_dict
+
+
+def chat(n):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"} for i in range(n)]
+
+
+class IndexedJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "chat.jsonl")
+        self.store = JournalStore(self.path)
+        self.store.save(chat(10))
+        self.assertIsNotNone(read_index(self.path, exact=False))
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def load(self):
+        return [as_dict(message) for message in JournalStore(self.path).load()]
+
+    def test_update_first_message(self):
+        self.store.record({"op": "update", "index": 0, "content": "edited"})
+        expected = chat(10)
+        expected[0]["content"] = "edited"
+        self.assertEqual(self.load(), expected)
+
+    def test_delete_first_message(self):
+        self.store.record({"op": "delete", "index": 0})
+        self.assertEqual(self.load(), chat(10)[1:])
+
+    def test_insert_at_start(self):
+        message = {"role": "user", "content": "first"}
+        self.store.record({"op": "insert", "index": 0, "message": message})
+        self.assertEqual(self.load(), [message] + chat(10))
+
+
+if __name__ == "__main__":
+    unittest.main()